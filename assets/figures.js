@@ -0,0 +1,12 @@
+// Clientside callbacks (see dash.clientside_callback) for view changes that don't need the server
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    nightscout: {
+        // Pick one of several precomputed figures, keyed by the value of the control that selects between them
+        pickFigure: function (figures, key) {
+            if (!figures) {
+                return window.dash_clientside.no_update;
+            }
+            return figures[String(key)];
+        },
+    },
+});
@@ -0,0 +1,48 @@
+"""
+Compare the speed of find_distinct_lows with the original row-by-row distinct low detection (whose results it is
+checked against in tests/test_analysis_utils.py). Run from the project root, e.g.:
+
+    python -m benchmarks.distinct_lows --days 365
+"""
+import argparse
+
+from benchmarks.run_benchmarks import END_DATE, TIMEZONE_NAME, time_call
+from benchmarks.synthetic_data import generate_nightscout_records
+from nightscout_dash.analysis_utils import find_distinct_lows
+from nightscout_loader import (
+    combine_entries_and_treatments,
+    entries_to_df,
+    treatments_to_df,
+)
+from tests.test_analysis_utils import find_distinct_lows_loop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    records = generate_nightscout_records(days=args.days, end_date=END_DATE)
+    all_data = combine_entries_and_treatments(
+        entries_to_df(records["entries"], TIMEZONE_NAME),
+        treatments_to_df(records["treatments"], TIMEZONE_NAME),
+        TIMEZONE_NAME,
+    )
+    cgm_data = all_data.loc[all_data["eventType"] == "sgv"].reset_index(drop=True)
+
+    params = (70, 80, 5)
+    loop_seconds = time_call(
+        lambda: find_distinct_lows_loop(cgm_data, *params), args.repeat
+    )
+    vectorized_seconds = time_call(
+        lambda: find_distinct_lows(cgm_data["bg"], *params), args.repeat
+    )
+    print(
+        f"{len(cgm_data)} readings: loop {loop_seconds:.3f} s, "
+        f"find_distinct_lows {vectorized_seconds:.4f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
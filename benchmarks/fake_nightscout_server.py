@@ -0,0 +1,277 @@
+"""
+A local stand-in for a Nightscout site, for testing the fetch path offline and under controlled latency and failures.
+
+Serves api/v1/entries.json, api/v1/treatments.json and api/v1/profile.json from synthetic (or previously recorded)
+records, honoring find[field][$op] filters and count the way Nightscout does. Run from the project root, e.g.:
+
+    python -m benchmarks.fake_nightscout_server --days 90 --port 1337 --latency 0.1
+    NIGHTSCOUT_URL=http://localhost:1337 python app.py
+
+or use FakeNightscoutServer as a context manager from Python.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from benchmarks.synthetic_data import generate_nightscout_records
+
+# Nightscout's default page size when no count is given
+DEFAULT_COUNT = 10
+# Field each collection is sorted on (newest first) and filtered by
+SORT_FIELDS = {"entries": "date", "treatments": "created_at"}
+OPERATORS = {
+    "$gte": lambda a, b: a >= b,
+    "$gt": lambda a, b: a > b,
+    "$lte": lambda a, b: a <= b,
+    "$lt": lambda a, b: a < b,
+    "$ne": lambda a, b: a != b,
+    "$eq": lambda a, b: a == b,
+}
+
+
+def parse_find_params(query: str) -> List[tuple]:
+    """
+    Parse find[field][$op]=value (and find[field]=value, meaning equality) query parameters.
+
+    :return: list of (field, operator, value string) tuples
+    """
+    filters = []
+    for key, value in parse_qsl(query):
+        if not key.startswith("find["):
+            continue
+        parts = key[len("find[") : -1].split("][")
+        field, op = (parts[0], parts[1]) if len(parts) > 1 else (parts[0], "$eq")
+        filters.append((field, op, value))
+    return filters
+
+
+def matches(record: dict, filters: List[tuple]) -> bool:
+    for field, op, value in filters:
+        if field not in record or op not in OPERATORS:
+            return False
+        record_value = record[field]
+        # Numeric fields (e.g. entry date in ms) compare as numbers, everything else (e.g. created_at) as strings
+        if isinstance(record_value, (int, float)):
+            try:
+                value = float(value)
+            except ValueError:
+                return False
+        else:
+            record_value = str(record_value)
+        if not OPERATORS[op](record_value, value):
+            return False
+    return True
+
+
+class FakeNightscoutServer:
+    """
+    Serve Nightscout records over HTTP from a background thread.
+
+        with FakeNightscoutServer(generate_nightscout_records(days=30), latency=0.05) as server:
+            data = fetch_nightscout_data(server.url, start_date, end_date, "America/New_York")
+
+    Fault injection is applied per request, before any filtering:
+        * latency (+ random jitter) seconds of delay
+        * more than max_concurrent_requests requests in flight at once get 429 Too Many Requests
+        * failure_rate is the fraction of requests that get failure_status instead of data
+
+    stats counts requests by path and by response status.
+    """
+
+    def __init__(
+        self,
+        records: Dict[str, List[dict]],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        max_concurrent_requests: Optional[int] = None,
+        failure_rate: float = 0.0,
+        failure_status: int = 503,
+        seed: int = 0,
+    ):
+        """
+        :param records: dict with keys "entries", "treatments" and "profiles", as returned by
+            generate_nightscout_records
+        :param port: port to listen on (0 picks a free port; see url)
+        :param latency: seconds to wait before answering each request
+        :param latency_jitter: up to this many additional random seconds of delay per request
+        :param max_concurrent_requests: throttle (429) requests beyond this many in flight; None means no limit
+        :param failure_rate: fraction of requests that fail with failure_status
+        :param failure_status: HTTP status returned for injected failures
+        :param seed: random seed for jitter and failures
+        """
+        self.collections = {
+            "entries": sorted(
+                records["entries"],
+                key=lambda r: r[SORT_FIELDS["entries"]],
+                reverse=True,
+            ),
+            "treatments": sorted(
+                records["treatments"],
+                key=lambda r: r[SORT_FIELDS["treatments"]],
+                reverse=True,
+            ),
+            "profile": sorted(
+                records["profiles"], key=lambda r: r["startDate"], reverse=True
+            ),
+        }
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.max_concurrent_requests = max_concurrent_requests
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = Counter()
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeNightscoutServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def query(self, collection: str, query: str) -> List[dict]:
+        """
+        :return: records from collection matching the query string's find parameters, newest first, limited to count
+        """
+        records = self.collections[collection]
+        filters = parse_find_params(query)
+        if collection == "profile":
+            # Nightscout returns all profiles regardless of count
+            return [record for record in records if matches(record, filters)]
+        count = int(dict(parse_qsl(query)).get("count", DEFAULT_COUNT))
+        results = []
+        for record in records:
+            if len(results) >= count:
+                break
+            if matches(record, filters):
+                results.append(record)
+        return results
+
+    def respond(self, path: str, query: str) -> tuple:
+        """
+        Apply fault injection, then answer the request.
+
+        :return: tuple of (HTTP status, JSON-serializable body)
+        """
+        with self.lock:
+            self.in_flight += 1
+            throttled = (
+                self.max_concurrent_requests is not None
+                and self.in_flight > self.max_concurrent_requests
+            )
+            failed = self.random.random() < self.failure_rate
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+        try:
+            if throttled:
+                return 429, {"status": 429, "message": "Too many requests"}
+            time.sleep(delay)
+            if failed:
+                return self.failure_status, {"status": self.failure_status}
+            collection = path.rstrip("/").rsplit("/", 1)[-1].replace(".json", "")
+            if not path.startswith("/api/v1/") or collection not in self.collections:
+                return 404, {"status": 404, "message": "Not found"}
+            return 200, self.query(collection, query)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                status, body = server.respond(url.path, url.query)
+                with server.lock:
+                    server.stats[url.path] += 1
+                    server.stats[status] += 1
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=1337)
+    parser.add_argument(
+        "--records",
+        help="JSON file with entries, treatments and profiles lists (default: generate synthetic data)",
+    )
+    parser.add_argument("--save-records", help="write the served records to this file")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--timezone", default="America/New_York")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--max-concurrent-requests", type=int)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=503)
+    args = parser.parse_args()
+
+    if args.records:
+        with open(args.records) as f:
+            records = json.load(f)
+    else:
+        records = generate_nightscout_records(
+            days=args.days, timezone_name=args.timezone
+        )
+    if args.save_records:
+        with open(args.save_records, "w") as f:
+            json.dump(records, f)
+
+    server = FakeNightscoutServer(
+        records,
+        host="",
+        port=args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        max_concurrent_requests=args.max_concurrent_requests,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status,
+    )
+    print(f"Serving fake Nightscout on {server.url} (Ctrl-C to stop)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Load-test the Nightscout fetch path against a local fake Nightscout server with injected latency, throttling and
+failures. Run from the project root, e.g.:
+
+    python -m benchmarks.fetch_load_test --days 90 --latency 0.1 --workers 1 2 4 8
+    python -m benchmarks.fetch_load_test --max-concurrent-requests 3 --failure-rate 0.05
+
+Every run is checked against a fetch with no injected faults, so dropped or duplicated records are reported.
+"""
+import argparse
+import datetime
+import time
+
+import requests
+
+from benchmarks.fake_nightscout_server import FakeNightscoutServer
+from benchmarks.synthetic_data import generate_nightscout_records
+from nightscout_loader import NightscoutClient
+
+TIMEZONE_NAME = "America/New_York"
+END_DATE = datetime.date(2023, 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--page-size", type=int, default=2000)
+    parser.add_argument("--window-days", type=int, default=7)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--max-concurrent-requests", type=int)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    records = generate_nightscout_records(days=args.days, end_date=END_DATE)
+    start_date = END_DATE - datetime.timedelta(days=args.days)
+    end_date = END_DATE
+
+    def fetch(server: FakeNightscoutServer, max_workers: int):
+        with NightscoutClient(server.url, max_workers=max_workers) as client:
+            return client.fetch_data(
+                start_date,
+                end_date,
+                TIMEZONE_NAME,
+                window_days=args.window_days,
+                page_size=args.page_size,
+            )
+
+    with FakeNightscoutServer(records) as server:
+        expected = fetch(server, 1)
+    print(f"{args.days} days, {len(expected)} rows expected")
+
+    for max_workers in args.workers:
+        with FakeNightscoutServer(
+            records,
+            latency=args.latency,
+            latency_jitter=args.latency_jitter,
+            max_concurrent_requests=args.max_concurrent_requests,
+            failure_rate=args.failure_rate,
+        ) as server:
+            start = time.perf_counter()
+            try:
+                data = fetch(server, max_workers)
+                outcome = "ok" if data.equals(expected) else "MISMATCH"
+            except requests.exceptions.RequestException as e:
+                outcome = f"failed: {type(e).__name__}"
+            elapsed = time.perf_counter() - start
+            statuses = {
+                status: count
+                for status, count in server.stats.items()
+                if isinstance(status, int)
+            }
+        print(
+            f"  max_workers={max_workers:<3} {elapsed:7.2f} s  "
+            f"requests={sum(statuses.values()):<5} statuses={statuses}  {outcome}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Time each stage of loading and analyzing Nightscout data on synthetic datasets of increasing size.
+
+Run from the project root, e.g.:
+
+    python -m benchmarks.run_benchmarks --label my-change
+    python -m benchmarks.run_benchmarks --sizes 1w 3m --compare benchmarks/results/main.json
+
+Results are written to benchmarks/results/<label>.json so that later runs can be compared against them.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Callable, Dict
+
+import pandas as pd
+
+from benchmarks.synthetic_data import generate_nightscout_records
+from nightscout_dash.basal_rate_plot import BasalRatePlot
+from nightscout_dash.data_utils import (
+    bg_data_json_to_df,
+    df_to_store_data,
+    get_decode_cache,
+    get_store_mode,
+    STORE_MODES,
+    profile_json_to_df,
+)
+from nightscout_dash.distribution_table import DistributionTable
+from nightscout_dash.site_change_plot import SiteChangePlot
+from nightscout_loader import (
+    combine_entries_and_treatments,
+    entries_to_df,
+    get_basal_per_hour,
+    get_memory_per_day,
+    profiles_to_df,
+    treatments_to_df,
+)
+
+SIZES = {"1w": 7, "3m": 91, "1y": 365, "3y": 3 * 365}
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+TIMEZONE_NAME = "America/New_York"
+END_DATE = datetime.date(2023, 1, 1)
+DISTRIBUTION_TABLE_ROWS = [
+    {"lower": None, "upper": 55, "label": "Very low"},
+    {"lower": 55, "upper": 70, "label": "Low"},
+    {"lower": 70, "upper": 180, "label": "In range"},
+    {"lower": 180, "upper": 300, "label": "High"},
+    {"lower": 300, "upper": None, "label": "Very high"},
+]
+
+
+def time_call(func: Callable, repeat: int) -> float:
+    """
+    :return: best wall-clock time of repeat calls to func, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_size(days: int, repeat: int) -> Dict[str, float]:
+    """
+    Time every stage on one synthetic dataset.
+
+    :return: dict mapping stage name to seconds (plus a few size metrics)
+    """
+    records = generate_nightscout_records(days=days, end_date=END_DATE)
+    start_date = END_DATE - datetime.timedelta(days=days)
+    end_date = END_DATE - datetime.timedelta(days=1)
+    start_date_str, end_date_str = start_date.isoformat(), end_date.isoformat()
+
+    def build_frames():
+        return combine_entries_and_treatments(
+            entries_to_df(records["entries"], TIMEZONE_NAME),
+            treatments_to_df(records["treatments"], TIMEZONE_NAME),
+            TIMEZONE_NAME,
+        )
+
+    all_data = build_frames()
+    profiles = profiles_to_df(records["profiles"], TIMEZONE_NAME)
+    bg_json = df_to_store_data(all_data)
+    profile_json = df_to_store_data(profiles)
+
+    results = {
+        "rows": len(all_data),
+        "memory_per_day_bytes": get_memory_per_day(all_data),
+        "store_payload_bytes": len(bg_json),
+    }
+    stages = {
+        "build_frames": build_frames,
+        "profiles_to_df": lambda: profiles_to_df(records["profiles"], TIMEZONE_NAME),
+        "get_basal_per_hour": lambda: get_basal_per_hour(
+            all_data, profiles, start_date, end_date, TIMEZONE_NAME
+        ),
+        "encode_store": lambda: df_to_store_data(all_data),
+        "decode_store": lambda: (
+            get_decode_cache().clear(),
+            bg_data_json_to_df(bg_json, TIMEZONE_NAME),
+            profile_json_to_df(profile_json, TIMEZONE_NAME),
+        ),
+        "basal_rate_plot": lambda: BasalRatePlot.make_figures(
+            bg_json,
+            profile_json,
+            start_date_str,
+            end_date_str,
+            TIMEZONE_NAME,
+        ),
+        "distribution_table": lambda: DistributionTable.summarize(
+            bg_json,
+            profile_json,
+            [dict(row) for row in DISTRIBUTION_TABLE_ROWS],
+            None,
+            None,
+            [],
+            TIMEZONE_NAME,
+            70,
+            80,
+            5,
+            "distribution-summary-table",
+        ),
+        "site_change_plot": lambda: SiteChangePlot.make_figures(
+            bg_json, TIMEZONE_NAME, 6
+        ),
+    }
+    for stage, func in stages.items():
+        results[stage] = time_call(func, repeat)
+        print(f"  {stage:<22} {results[stage]:8.3f} s")
+    return results
+
+
+def get_metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "store_mode": get_store_mode(),
+    }
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Print the ratio of each timing to the same timing in a baseline run (> 1 means slower than baseline).
+    """
+    print(f"\nComparison against baseline from {baseline['metadata']['timestamp']}:")
+    for size, stages in results["results"].items():
+        baseline_stages = baseline["results"].get(size, {})
+        for stage, seconds in stages.items():
+            if stage in baseline_stages and baseline_stages[stage]:
+                ratio = seconds / baseline_stages[stage]
+                flag = "  <-- regression?" if ratio > 1.25 else ""
+                print(f"  {size:<4} {stage:<22} {ratio:6.2f}x{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--label", default="latest")
+    parser.add_argument("--compare", help="path to a previous results file")
+    parser.add_argument(
+        "--store-mode",
+        choices=STORE_MODES,
+        help="how data is passed through dcc.Store (default: NIGHTSCOUT_STORE_MODE)",
+    )
+    args = parser.parse_args()
+    if args.store_mode:
+        os.environ["NIGHTSCOUT_STORE_MODE"] = args.store_mode
+
+    results = {"metadata": get_metadata(), "results": {}}
+    for size in args.sizes:
+        print(f"{size} ({SIZES[size]} days)")
+        results["results"][size] = run_size(SIZES[size], args.repeat)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f"{args.label}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {results_path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Compare the dcc.Store encodings (JSON vs binary column buffers) by encode time, decode time and payload size.
+Run from the project root, e.g.:
+
+    python -m benchmarks.store_encodings --sizes 1w 3m 1y
+"""
+import argparse
+
+from benchmarks.run_benchmarks import END_DATE, SIZES, TIMEZONE_NAME, time_call
+from benchmarks.synthetic_data import generate_nightscout_records
+from nightscout_dash.data_utils import (
+    bg_data_json_to_df,
+    df_to_binary,
+    get_decode_cache,
+)
+from nightscout_loader import (
+    combine_entries_and_treatments,
+    entries_to_df,
+    treatments_to_df,
+)
+
+ENCODERS = {
+    "json": lambda df: df.to_json(orient="split", date_unit="ns"),
+    "binary": df_to_binary,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        f"{'size':<5} {'encoding':<8} {'encode s':>9} {'decode s':>9} {'payload MB':>11}"
+    )
+    for size in args.sizes:
+        records = generate_nightscout_records(days=SIZES[size], end_date=END_DATE)
+        all_data = combine_entries_and_treatments(
+            entries_to_df(records["entries"], TIMEZONE_NAME),
+            treatments_to_df(records["treatments"], TIMEZONE_NAME),
+            TIMEZONE_NAME,
+        )
+        for encoding, encode in ENCODERS.items():
+            payload = encode(all_data)
+            encode_seconds = time_call(lambda: encode(all_data), args.repeat)
+            decode_seconds = time_call(
+                lambda: (
+                    get_decode_cache().clear(),
+                    bg_data_json_to_df(payload, TIMEZONE_NAME),
+                ),
+                args.repeat,
+            )
+            print(
+                f"{size:<5} {encoding:<8} {encode_seconds:9.3f} {decode_seconds:9.3f} "
+                f"{len(payload) / 1e6:11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import datetime
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from nightscout_loader import format_created_at
+
+
+def format_date_string(timestamp: pd.Timestamp) -> str:
+    """
+    Format a timestamp the way Nightscout stores entry dateString values.
+    """
+    return timestamp.isoformat(timespec="milliseconds")
+
+
+def generate_profiles(
+    rng: np.random.Generator,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    n_profile_switches: int,
+) -> List[dict]:
+    """
+    Generate profile records in the format returned by the Nightscout profile endpoint: one profile in effect before
+    start, plus n_profile_switches profiles taking effect at random times between start and end.
+    """
+    switch_offsets = np.sort(
+        rng.uniform(0, (end - start).total_seconds(), n_profile_switches)
+    )
+    profile_starts = [start - datetime.timedelta(days=30)] + [
+        start + datetime.timedelta(seconds=float(offset)) for offset in switch_offsets
+    ]
+    profiles = []
+    for i, profile_start in enumerate(profile_starts):
+        rate_hours = np.sort(
+            rng.choice(np.arange(1, 24), size=rng.integers(3, 7), replace=False)
+        )
+        name = f"Profile {i % 4}"
+        profiles.append(
+            {
+                "_id": f"profile{i:05d}",
+                "defaultProfile": name,
+                "startDate": format_created_at(profile_start),
+                "store": {
+                    name: {
+                        "basal": [
+                            {
+                                "time": f"{hour:02d}:00",
+                                "timeAsSeconds": int(hour * 3600),
+                                "value": round(float(rng.uniform(0.4, 1.6)), 2),
+                            }
+                            for hour in [0] + list(rate_hours)
+                        ]
+                    }
+                },
+            }
+        )
+    return profiles
+
+
+def generate_nightscout_records(
+    days: int = 90,
+    end_date: datetime.date = datetime.date(2023, 1, 1),
+    timezone_name: str = "America/New_York",
+    n_profile_switches: int = None,
+    seed: int = 0,
+) -> Dict[str, List[dict]]:
+    """
+    Generate a deterministic synthetic Nightscout dataset, in the same format the Nightscout API returns.
+
+    The data covers the local dates [end_date - days, end_date) and includes 5-minute CGM readings (with occasional
+    gaps), a fingerstick per day, Control-IQ style temp basals every 5-30 minutes, automatic boluses, meal boluses,
+    site changes every ~3 days, and profile switches. Use a timezone with daylight saving time (the default) to
+    include DST transitions.
+
+    :param days: number of days of data
+    :param end_date: local date after the last day of data
+    :param timezone_name: Timezone name e.g. 'America/New_York'
+    :param n_profile_switches: number of profile changes during the range (defaults to one per 30 days)
+    :param seed: random seed; the same arguments always produce the same records
+    :return: dict with keys "entries", "treatments", and "profiles", each a list of records
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end_date).tz_localize(timezone_name)
+    start = pd.Timestamp(end_date - datetime.timedelta(days=days)).tz_localize(
+        timezone_name
+    )
+    if n_profile_switches is None:
+        n_profile_switches = days // 30
+
+    # CGM readings every 5 minutes, with a daily cycle, a random walk, and a few dropped readings
+    cgm_times = pd.date_range(start, end, freq="5min", inclusive="left")
+    cgm_times = cgm_times + pd.to_timedelta(
+        rng.integers(0, 5000, len(cgm_times)), unit="ms"
+    )
+    hours = (cgm_times.hour + cgm_times.minute / 60).to_numpy()
+    walk = np.cumsum(rng.normal(0, 4, len(cgm_times)))
+    walk -= np.convolve(walk, np.ones(144) / 144, mode="same")
+    sgv = np.clip(130 + 40 * np.sin(hours / 24 * 2 * np.pi) + walk, 40, 400).astype(int)
+    keep = rng.random(len(cgm_times)) > 0.01
+    entries = [
+        {
+            "_id": f"sgv{i:08d}",
+            "type": "sgv",
+            "sgv": int(sgv[i]),
+            "date": int(cgm_times[i].timestamp() * 1000),
+            "dateString": format_date_string(cgm_times[i]),
+            "direction": "Flat",
+            "device": "synthetic",
+        }
+        for i in np.flatnonzero(keep)
+    ]
+    for day in range(days):
+        fingerstick_time = start + datetime.timedelta(
+            days=day, hours=float(rng.uniform(6, 10))
+        )
+        entries.append(
+            {
+                "_id": f"mbg{day:08d}",
+                "type": "mbg",
+                "mbg": int(rng.integers(70, 200)),
+                "date": int(fingerstick_time.timestamp() * 1000),
+                "dateString": format_date_string(fingerstick_time),
+                "device": "synthetic",
+            }
+        )
+
+    treatments = []
+
+    def add_treatment(timestamp: pd.Timestamp, **fields) -> None:
+        treatments.append(
+            {
+                "_id": f"treatment{len(treatments):08d}",
+                "created_at": format_created_at(timestamp),
+                "enteredBy": "synthetic",
+                **fields,
+            }
+        )
+
+    # Temp basals
+    temp_basal_offsets = np.cumsum(rng.uniform(5, 30, int(days * 24 * 60 / 5)) * 60)
+    for offset in temp_basal_offsets[
+        temp_basal_offsets < (end - start).total_seconds()
+    ]:
+        rate = round(float(rng.choice([0.0, rng.uniform(0.2, 3.0)], p=[0.2, 0.8])), 2)
+        add_treatment(
+            start + datetime.timedelta(seconds=float(offset)),
+            eventType="Temp Basal",
+            duration=float(rng.choice([5, 15, 30, 60])),
+            absolute=rate,
+            rate=rate,
+            reason="Control-IQ",
+        )
+    # Automatic boluses (roughly every 2 hours) and meal boluses (3 per day)
+    for offset in rng.uniform(0, (end - start).total_seconds(), days * 12):
+        add_treatment(
+            start + datetime.timedelta(seconds=float(offset)),
+            eventType="Correction Bolus",
+            insulin=round(float(rng.uniform(0.1, 1.5)), 2),
+            notes="Automatic Bolus/Correction",
+        )
+    for day in range(days):
+        for meal_hour in (7.5, 12.5, 18.5):
+            carbs = int(rng.integers(10, 80))
+            add_treatment(
+                start
+                + datetime.timedelta(days=day, hours=meal_hour + rng.normal(0, 0.5)),
+                eventType="Meal Bolus",
+                carbs=carbs,
+                insulin=round(carbs / 10, 2),
+            )
+    # Site changes every ~3 days
+    for day in np.arange(0, days, 3):
+        add_treatment(
+            start + datetime.timedelta(days=int(day), hours=float(rng.uniform(8, 22))),
+            eventType="Site Change",
+            notes="synthetic site change",
+        )
+
+    return {
+        "entries": entries,
+        "treatments": treatments,
+        "profiles": generate_profiles(rng, start, end, n_profile_switches),
+    }
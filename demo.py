@@ -28,8 +28,8 @@ if __name__ == "__main__":
 
     fasting_smbg = bg.loc[
         (bg["eventType"] == "mbg")
-        & (datetime.time(hour=6) < bg["time"])
-        & (bg["time"] < datetime.time(hour=12))
+        & (datetime.time(hour=6) < bg["datetime"].dt.time)
+        & (bg["datetime"].dt.time < datetime.time(hour=12))
     ]
     print("Fasting blood sugar measurements")
     print(fasting_smbg[["date", "time_str", "bg"]].reset_index(drop=True))
@@ -0,0 +1,191 @@
+import contextlib
+import datetime
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, Optional
+
+import pandas as pd
+
+# Partitions fetched less than this long after their local day ended may still be missing late uploads, so they are
+# refetched rather than served from the cache.
+DEFAULT_GRACE_PERIOD = datetime.timedelta(hours=1)
+DEFAULT_MAX_MB = 500
+
+
+class NightscoutCache:
+    """
+    On-disk cache of Nightscout entries and treatments, stored in SQLite as one partition per local date and keyed by
+    (normalized Nightscout URL, timezone name, date).
+
+    Each partition records when it was fetched. A partition fetched after its local day ended (plus a grace period for
+    late uploads) is complete and never changes, so it can be served without any request to Nightscout. Partitions for
+    today, or fetched while their day was still in progress, are stored but treated as missing so they are always
+    refetched. When the cache grows past max_bytes, the least-recently-used partitions are evicted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024,
+        grace_period: datetime.timedelta = DEFAULT_GRACE_PERIOD,
+    ):
+        """
+        :param cache_dir: directory to store the cache database in (created if needed)
+        :param max_bytes: maximum total size of stored partitions before eviction
+        :param grace_period: how long after the end of a local day data for that day may still arrive
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "nightscout_cache.sqlite")
+        self.max_bytes = max_bytes
+        self.grace_period = grace_period
+        with self.connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS partitions (
+                    nightscout_url TEXT NOT NULL,
+                    timezone_name TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    complete INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (nightscout_url, timezone_name, date)
+                )
+                """
+            )
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # A new connection per operation keeps this safe to share across threads and worker processes. The connection
+        # commits (or rolls back) the transaction and is closed on exit; using it as a context manager alone would
+        # leave it open.
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            with conn:
+                yield conn
+
+    def get_partitions(
+        self,
+        nightscout_url: str,
+        timezone_name: str,
+        dates: Iterable[datetime.date],
+    ) -> Dict[datetime.date, pd.DataFrame]:
+        """
+        Look up complete partitions for the given dates.
+
+        :return: dict mapping date to the DataFrame stored for that date, for dates with a complete partition only
+        """
+        date_strs = [date.isoformat() for date in dates]
+        partitions = {}
+        with self.connect() as conn:
+            for date_str in date_strs:
+                row = conn.execute(
+                    "SELECT data FROM partitions WHERE nightscout_url = ? AND timezone_name = ? AND date = ? "
+                    "AND complete = 1",
+                    (nightscout_url, timezone_name, date_str),
+                ).fetchone()
+                if row is None:
+                    continue
+                try:
+                    partitions[datetime.date.fromisoformat(date_str)] = pickle.loads(
+                        zlib.decompress(row[0])
+                    )
+                except Exception:
+                    # e.g. written by an incompatible pandas version; treat as missing and refetch
+                    conn.execute(
+                        "DELETE FROM partitions WHERE nightscout_url = ? AND timezone_name = ? AND date = ?",
+                        (nightscout_url, timezone_name, date_str),
+                    )
+            conn.executemany(
+                "UPDATE partitions SET last_access = ? WHERE nightscout_url = ? AND timezone_name = ? AND date = ?",
+                [
+                    (time.time(), nightscout_url, timezone_name, date.isoformat())
+                    for date in partitions
+                ],
+            )
+        return partitions
+
+    def put_partitions(
+        self,
+        nightscout_url: str,
+        timezone_name: str,
+        partitions: Dict[datetime.date, pd.DataFrame],
+        fetched_at: float,
+    ) -> None:
+        """
+        Store one DataFrame per local date, replacing anything already stored for those dates.
+
+        :param partitions: dict mapping date to all data for that date (an empty DataFrame if there was none)
+        :param fetched_at: unix time at which the request for this data was issued
+        """
+        rows = []
+        for date, df in partitions.items():
+            data = zlib.compress(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+            day_end = pd.Timestamp(date + datetime.timedelta(days=1)).tz_localize(
+                timezone_name, ambiguous=True, nonexistent="shift_forward"
+            )
+            complete = fetched_at >= (day_end + self.grace_period).timestamp()
+            rows.append(
+                (
+                    nightscout_url,
+                    timezone_name,
+                    date.isoformat(),
+                    fetched_at,
+                    int(complete),
+                    time.time(),
+                    len(data),
+                    data,
+                )
+            )
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove least-recently-used partitions until the total size is at most max_bytes.
+        """
+        with self.connect() as conn:
+            total_bytes = conn.execute(
+                "SELECT COALESCE(SUM(size_bytes), 0) FROM partitions"
+            ).fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return
+            to_delete = []
+            for rowid, size_bytes in conn.execute(
+                "SELECT rowid, size_bytes FROM partitions ORDER BY last_access"
+            ):
+                if total_bytes <= self.max_bytes:
+                    break
+                to_delete.append((rowid,))
+                total_bytes -= size_bytes
+            conn.executemany("DELETE FROM partitions WHERE rowid = ?", to_delete)
+
+    def clear(self) -> None:
+        with self.connect() as conn:
+            conn.execute("DELETE FROM partitions")
+
+
+def get_default_cache() -> Optional[NightscoutCache]:
+    """
+    Get the cache configured by environment variables:
+        * NIGHTSCOUT_CACHE_DIR: directory for the cache (defaults to ~/.cache/nightscout-analysis; set to an empty
+          string to disable caching)
+        * NIGHTSCOUT_CACHE_MAX_MB: maximum cache size in MB (defaults to 500)
+
+    :return: NightscoutCache, or None if caching is disabled
+    """
+    cache_dir = os.getenv(
+        "NIGHTSCOUT_CACHE_DIR",
+        default=os.path.join(os.path.expanduser("~"), ".cache", "nightscout-analysis"),
+    )
+    if not cache_dir:
+        return None
+    max_mb = float(os.getenv("NIGHTSCOUT_CACHE_MAX_MB", default=DEFAULT_MAX_MB))
+    return NightscoutCache(cache_dir, max_bytes=int(max_mb * 1024 * 1024))
@@ -0,0 +1,175 @@
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Width of the bins that site change stats are accumulated in, before combining them into the bins shown
+SITE_CHANGE_FINE_BIN_MINUTES = 5
+NANOSECONDS_PER_MINUTE = 60 * 10**9
+# Readings above this many mg/dL share the top column of a daily_cumulative_histogram, so one bad reading can't make
+# it arbitrarily wide
+MAX_HISTOGRAM_BG = 1000
+
+
+def find_distinct_lows(
+    bg: pd.Series,
+    low_threshold: float,
+    recovered_threshold: float,
+    n_recovered_pts_between_lows: int,
+) -> np.ndarray:
+    """
+    Find the readings that start a distinct low: a reading <= low_threshold, with at least
+    n_recovered_pts_between_lows readings > recovered_threshold (not necessarily consecutive) since the previous
+    distinct low.
+
+    Each distinct low is the first low reading whose running count of recovered readings is at least
+    n_recovered_pts_between_lows above the count at the previous distinct low. Those counts never decrease, so the
+    next distinct low after any low can be found for all of them at once by binary search, and the distinct lows are
+    then a chain of jumps taking one step per low episode rather than per low reading.
+
+    :param bg: CGM readings, in time order
+    :param low_threshold: readings at or below this are low
+    :param recovered_threshold: readings above this count towards recovery from a low
+    :param n_recovered_pts_between_lows: number of recovered readings needed before another low counts as distinct
+    :return: boolean array, True at readings that start a distinct low
+    """
+    bg = np.asarray(bg, dtype=float)
+    recovered_point_count = np.cumsum(bg > recovered_threshold)
+    low_positions = np.flatnonzero(bg <= low_threshold)
+    low_counts = recovered_point_count[low_positions]
+    # For each low, the next low that would be distinct if this one was (always at least the next low)
+    next_distinct = np.maximum(
+        np.searchsorted(low_counts, low_counts + n_recovered_pts_between_lows),
+        np.arange(1, len(low_positions) + 1),
+    )
+
+    is_distinct_low = np.zeros(len(bg), dtype=bool)
+    i = 0
+    while i < len(low_positions):
+        is_distinct_low[low_positions[i]] = True
+        i = next_distinct[i]
+    return is_distinct_low
+
+
+def daily_cumulative_histogram(bg: pd.Series, dates: pd.Series) -> pd.DataFrame:
+    """
+    Count each day's readings below every whole mg/dL value, so that the number of readings in any range on any day
+    can be looked up without going back to the readings (see range_fractions). Missing readings are left out, and
+    readings are clipped to [0, MAX_HISTOGRAM_BG].
+
+    :param bg: BG readings
+    :param dates: date of each reading
+    :return: DataFrame indexed by date, where column v (from 0 to one above the highest clipped reading) is the number
+        of readings that day below v mg/dL; the last column is the number of readings that day
+    """
+    bg = np.asarray(bg, dtype=float)
+    valid = ~np.isnan(bg)
+    values = np.clip(np.floor(bg[valid]), 0, MAX_HISTOGRAM_BG).astype(np.int64)
+    day_codes, days = pd.factorize(np.asarray(dates)[valid], sort=True)
+    n_values = int(values.max()) + 1 if len(values) else 0
+    counts = np.bincount(
+        day_codes * n_values + values, minlength=len(days) * n_values
+    ).reshape(len(days), n_values)
+    cumulative_counts = np.zeros((len(days), n_values + 1), dtype=np.int32)
+    np.cumsum(counts, axis=1, out=cumulative_counts[:, 1:])
+    return pd.DataFrame(cumulative_counts, index=pd.Index(days, name="date"))
+
+
+def range_fractions(
+    histogram: pd.DataFrame, ranges: List[Tuple[float, float]]
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """
+    Find the fraction of readings in each of several BG ranges [lower, upper), overall and per day, from a
+    daily_cumulative_histogram. Each range on each day is a difference of two counts, so this takes
+    O(days x ranges) however many readings there are. Exact for whole-number readings up to MAX_HISTOGRAM_BG, as
+    CGM readings are.
+
+    :param histogram: result of daily_cumulative_histogram
+    :param ranges: list of (lower, upper) tuples; ranges may overlap, and upper bounds may be infinite, but no
+        bound may be NaN
+    :return: tuple of (array with the fraction of all readings in each range, DataFrame with the fraction of each
+        day's readings in each range, indexed by date with one column per range)
+    """
+    cumulative_counts = histogram.to_numpy()
+    n_columns = cumulative_counts.shape[1]
+
+    def count_columns(bounds) -> np.ndarray:
+        # Column counting the readings below each bound
+        return np.clip(
+            np.ceil(np.asarray(bounds, dtype=float)), 0, n_columns - 1
+        ).astype(np.int64)
+
+    lowers = count_columns([lower for lower, _ in ranges])
+    uppers = count_columns([upper for _, upper in ranges])
+    range_counts = np.maximum(
+        cumulative_counts[:, uppers] - cumulative_counts[:, lowers], 0
+    )
+    day_totals = cumulative_counts[:, -1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overall = range_counts.sum(axis=0) / day_totals.sum()
+        per_day = range_counts / day_totals[:, np.newaxis]
+    return overall, pd.DataFrame(per_day, index=histogram.index)
+
+
+def site_change_accumulators(all_bg_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Align each CGM reading with the most recent site change before it, and accumulate the sum, sum of squares and
+    number of readings per (SITE_CHANGE_FINE_BIN_MINUTES bin of time since site change, local hour of day). Stats for
+    any bin width that is a whole number of fine bins can then be derived with summarize_accumulators, without going
+    back to the readings. Readings before the first site change, or without a value, are left out.
+
+    :param all_bg_data: bg data as returned by fetch_nightscout_data, sorted by datetime
+    :return: DataFrame with columns fine_bin (number of whole fine bins since the site change), hour_of_day, sum,
+        sum_sq and count
+    """
+    site_change_times = (
+        all_bg_data.loc[all_bg_data["eventType"] == "Site Change", "datetime"]
+        .to_numpy("datetime64[ns]")
+        .view(np.int64)
+    )
+    cgm_data = all_bg_data.loc[
+        (all_bg_data["eventType"] == "sgv") & all_bg_data["bg"].notna()
+    ]
+    times = cgm_data["datetime"].to_numpy("datetime64[ns]").view(np.int64)
+    # Index of the latest site change at or before each reading, as with merge_asof
+    site_change_index = np.searchsorted(site_change_times, times, side="right") - 1
+    aligned = site_change_index >= 0
+    time_since = times[aligned] - site_change_times[site_change_index[aligned]]
+    fine_bins = time_since // (SITE_CHANGE_FINE_BIN_MINUTES * NANOSECONDS_PER_MINUTE)
+    hours_of_day = cgm_data["datetime"].dt.hour.to_numpy()[aligned]
+    bg = cgm_data["bg"].to_numpy(dtype=float)[aligned]
+
+    keys, key_codes = np.unique(fine_bins * 24 + hours_of_day, return_inverse=True)
+    return pd.DataFrame(
+        {
+            "fine_bin": keys // 24,
+            "hour_of_day": keys % 24,
+            "sum": np.bincount(key_codes, weights=bg, minlength=len(keys)),
+            "sum_sq": np.bincount(key_codes, weights=bg**2, minlength=len(keys)),
+            "count": np.bincount(key_codes, minlength=len(keys)),
+        }
+    )
+
+
+def summarize_accumulators(accumulators: pd.DataFrame, by) -> pd.DataFrame:
+    """
+    Combine sum/sum of squares/count accumulators (e.g. from site_change_accumulators) into coarser groups.
+
+    :param accumulators: DataFrame with sum, sum_sq and count columns
+    :param by: grouping for DataFrame.groupby, e.g. column names or arrays of group keys
+    :return: DataFrame indexed by group, with columns mean_bg, std_bg (sample standard deviation; NaN for groups with
+        a single reading) and n
+    """
+    totals = accumulators[["sum", "sum_sq", "count"]].groupby(by).sum()
+    n = totals["count"]
+    mean = totals["sum"] / n
+    variance = (totals["sum_sq"] - totals["sum"] * mean) / (n - 1)
+    return pd.DataFrame(
+        {
+            "mean_bg": mean,
+            # Rounding can make the variance of near-identical readings slightly negative
+            "std_bg": np.sqrt(variance.clip(lower=0)).where(n > 1),
+            "n": n,
+        }
+    )
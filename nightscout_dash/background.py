@@ -0,0 +1,47 @@
+import os
+
+DEFAULT_BACKGROUND_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "nightscout-analysis", "background"
+)
+
+_manager = None
+
+
+def background_callbacks_enabled() -> bool:
+    """
+    Whether long-running callbacks (loading data from Nightscout) run as Dash background callbacks, from the
+    NIGHTSCOUT_BACKGROUND_CALLBACKS environment variable ("1"/"true" to enable; disabled by default).
+    """
+    return os.getenv("NIGHTSCOUT_BACKGROUND_CALLBACKS", default="").lower() in [
+        "1",
+        "true",
+        "yes",
+    ]
+
+
+def get_background_dir() -> str:
+    """
+    Directory shared by the web server and background job processes, from NIGHTSCOUT_BACKGROUND_DIR (defaults to
+    ~/.cache/nightscout-analysis/background).
+    """
+    return os.getenv("NIGHTSCOUT_BACKGROUND_DIR") or DEFAULT_BACKGROUND_DIR
+
+
+def get_background_callback_manager():
+    """
+    Get the manager that runs background callbacks in separate processes, using a diskcache job queue in
+    get_background_dir(). Requires the diskcache extra (pip install "dash[diskcache]").
+
+    :return: DiskcacheManager, or None if background callbacks are disabled
+    """
+    global _manager
+    if not background_callbacks_enabled():
+        return None
+    if _manager is None:
+        import diskcache
+        from dash import DiskcacheManager
+
+        _manager = DiskcacheManager(
+            diskcache.Cache(os.path.join(get_background_dir(), "jobs"))
+        )
+    return _manager
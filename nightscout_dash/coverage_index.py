@@ -0,0 +1,169 @@
+import bisect
+import datetime
+import json
+from typing import List, Tuple
+
+import pandas as pd
+
+from nightscout_cache import DEFAULT_GRACE_PERIOD
+
+DateInterval = Tuple[datetime.date, datetime.date]
+
+
+class CoverageIndex:
+    """
+    Record of which local dates have been loaded from one Nightscout site in one timezone, as sorted, non-overlapping
+    half-open date intervals [start, end), each with the time it was fetched.
+
+    Adjacent intervals are merged if they were loaded at the same time, or if both were loaded after their last day
+    was over (plus a grace period for late uploads), since then when they were loaded no longer matters. Only the few
+    most recent days can be incomplete, so the index stays a handful of intervals however many days are loaded or
+    how often they are refreshed, and can be kept in a dcc.Store (see to_json/from_json). Finding the missing parts of
+    a requested range is a binary search plus a walk over the intervals that overlap it.
+    """
+
+    def __init__(
+        self,
+        nightscout_url: str,
+        timezone_name: str,
+        grace_period: datetime.timedelta = DEFAULT_GRACE_PERIOD,
+    ):
+        """
+        :param grace_period: how long after the end of a local day data for that day may still arrive
+        """
+        self.nightscout_url = nightscout_url
+        self.timezone_name = timezone_name
+        self.grace_period = grace_period
+        # Parallel lists, sorted by start; intervals never overlap
+        self.starts: List[datetime.date] = []
+        self.ends: List[datetime.date] = []
+        self.fetched_at: List[float] = []
+
+    def matches(self, nightscout_url: str, timezone_name: str) -> bool:
+        """
+        :return: whether this index describes data for nightscout_url in timezone_name (local dates depend on both)
+        """
+        return (
+            self.nightscout_url == nightscout_url
+            and self.timezone_name == timezone_name
+        )
+
+    @property
+    def intervals(self) -> List[Tuple[datetime.date, datetime.date, float]]:
+        return list(zip(self.starts, self.ends, self.fetched_at))
+
+    def _interval(self, i: int) -> Tuple[datetime.date, datetime.date, float]:
+        return self.starts[i], self.ends[i], self.fetched_at[i]
+
+    def _first_incomplete(self, fetched_at: float) -> datetime.date:
+        # First local date that hadn't ended (with grace period) at fetched_at
+        return (
+            (pd.Timestamp(fetched_at, unit="s", tz="UTC") - self.grace_period)
+            .tz_convert(self.timezone_name)
+            .date()
+        )
+
+    def _is_complete(
+        self, interval: Tuple[datetime.date, datetime.date, float]
+    ) -> bool:
+        start, end, fetched_at = interval
+        return self._first_incomplete(fetched_at) >= end
+
+    def _overlapping(self, start: datetime.date, end: datetime.date) -> range:
+        # Intervals with end > start and start < end
+        return range(
+            bisect.bisect_right(self.ends, start), bisect.bisect_left(self.starts, end)
+        )
+
+    def missing(self, start: datetime.date, end: datetime.date) -> List[DateInterval]:
+        """
+        :return: sub-intervals of [start, end) that have not been loaded, in order
+        """
+        gaps = []
+        cursor = start
+        for i in self._overlapping(start, end):
+            if self.starts[i] > cursor:
+                gaps.append((cursor, self.starts[i]))
+            cursor = max(cursor, self.ends[i])
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def incomplete(
+        self, start: datetime.date, end: datetime.date
+    ) -> List[DateInterval]:
+        """
+        Find loaded dates that may be missing data because they were fetched before the day was over (plus a grace
+        period for late uploads), e.g. today, or yesterday if it was loaded yesterday.
+
+        :return: sub-intervals of [start, end) that were loaded but may be incomplete, in order
+        """
+        stale = []
+        for i in self._overlapping(start, end):
+            first_incomplete = self._first_incomplete(self.fetched_at[i])
+            stale_start = max(self.starts[i], first_incomplete, start)
+            stale_end = min(self.ends[i], end)
+            if stale_start < stale_end:
+                stale.append((stale_start, stale_end))
+        return stale
+
+    def add(self, start: datetime.date, end: datetime.date, fetched_at: float) -> None:
+        """
+        Record that [start, end) was loaded at fetched_at (unix time), replacing what was recorded for any of those
+        dates before.
+        """
+        if start >= end:
+            return
+        overlapping = self._overlapping(start, end)
+        i, j = overlapping.start, overlapping.stop
+        replacement = []
+        # Keep the parts of partially-overlapped intervals that stick out on either side
+        if i < j and self.starts[i] < start:
+            replacement.append((self.starts[i], start, self.fetched_at[i]))
+        replacement.append((start, end, fetched_at))
+        if i < j and self.ends[j - 1] > end:
+            replacement.append((end, self.ends[j - 1], self.fetched_at[j - 1]))
+        # Include the neighbouring intervals, then merge anything adjacent that was fetched at the same time or is
+        # complete on both sides. A merged complete interval keeps the later fetch time, which is still after its end.
+        if i > 0 and self.ends[i - 1] == start:
+            i -= 1
+            replacement.insert(0, self._interval(i))
+        if j < len(self.starts) and self.starts[j] == end:
+            replacement.append(self._interval(j))
+            j += 1
+        merged = [replacement[0]]
+        for interval in replacement[1:]:
+            previous = merged[-1]
+            if previous[1] == interval[0] and (
+                previous[2] == interval[2]
+                or (self._is_complete(previous) and self._is_complete(interval))
+            ):
+                merged[-1] = (previous[0], interval[1], max(previous[2], interval[2]))
+            else:
+                merged.append(interval)
+        replacement = merged
+        self.starts[i:j] = [interval[0] for interval in replacement]
+        self.ends[i:j] = [interval[1] for interval in replacement]
+        self.fetched_at[i:j] = [interval[2] for interval in replacement]
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "nightscout_url": self.nightscout_url,
+                "timezone_name": self.timezone_name,
+                "intervals": [
+                    [start.isoformat(), end.isoformat(), fetched_at]
+                    for start, end, fetched_at in self.intervals
+                ],
+            }
+        )
+
+    @classmethod
+    def from_json(cls, coverage_json: str) -> "CoverageIndex":
+        data = json.loads(coverage_json)
+        coverage = cls(data["nightscout_url"], data["timezone_name"])
+        for start, end, fetched_at in data["intervals"]:
+            coverage.starts.append(datetime.date.fromisoformat(start))
+            coverage.ends.append(datetime.date.fromisoformat(end))
+            coverage.fetched_at.append(fetched_at)
+        return coverage
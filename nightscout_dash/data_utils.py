@@ -1,38 +1,502 @@
-from typing import List
+import datetime
+from typing import Callable, List
 
+import base64
+import collections
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
 import pandas as pd
 import abc
 
+from nightscout_dash.analysis_utils import (
+    daily_cumulative_histogram,
+    site_change_accumulators,
+)
+from nightscout_dash.dataset_store import (
+    get_dataset_store,
+    is_dataset_handle,
+    is_dataset_view,
+    make_dataset_view,
+    parse_dataset_view,
+)
+from nightscout_loader import apply_compact_schema, get_basal_per_hour
+
+STORE_MODES = ["server", "json", "binary"]
+# Prefix marking a dcc.Store value as a df_to_binary payload
+BINARY_PREFIX = "binary:"
+DEFAULT_DECODE_CACHE_MAX_MB = 256
+# Columns of bg data that get_basal_per_hour uses
+BASAL_INPUT_COLUMNS = ["datetime", "duration", "absolute", "reason", "insulin", "notes"]
+
+
+def get_store_mode() -> str:
+    """
+    Get how DataFrames are passed through dcc.Store elements, from the NIGHTSCOUT_STORE_MODE environment variable:
+        * "binary" (default): serialize the whole DataFrame to compressed column buffers in the browser (see
+          df_to_binary)
+        * "json": serialize the whole DataFrame to JSON in the browser
+        * "server": keep DataFrames in the server-side dataset store and only send a handle to the browser. Handles
+          are only valid in the process that created them, so only use this with a single web worker process.
+    """
+    store_mode = os.getenv("NIGHTSCOUT_STORE_MODE", default="binary")
+    if store_mode not in STORE_MODES:
+        raise ValueError(
+            f"NIGHTSCOUT_STORE_MODE must be one of {STORE_MODES}, not {store_mode!r}"
+        )
+    return store_mode
+
+
+def df_to_store_data(df: pd.DataFrame) -> str:
+    """
+    Convert a dataframe (bg data or profiles) to the value to put in a dcc.Store element; see get_store_mode.
+    bg_data_json_to_df and profile_json_to_df convert it back.
+    """
+    store_mode = get_store_mode()
+    if store_mode == "server":
+        return get_dataset_store().put(df)
+    if store_mode == "binary":
+        return df_to_binary(df)
+    return df.to_json(orient="split", date_unit="ns")
+
+
+def release_store_data(old_value, new_value) -> None:
+    """
+    Free the server-side copy of a dcc.Store value that is being replaced, so superseded datasets don't fill up the
+    dataset store. Does nothing unless old_value is a dataset handle that new_value replaces.
+
+    :param old_value: previous value of the dcc.Store element
+    :param new_value: value being returned for it, or no_update
+    """
+    if (
+        is_dataset_handle(old_value)
+        and is_dataset_handle(new_value)
+        and new_value != old_value
+    ):
+        get_dataset_store().discard(old_value)
+
+
+def subset_to_store_data(
+    bg_data: str,
+    all_bg_data: pd.DataFrame,
+    start_date: datetime.date,
+    end_date: datetime.date,
+) -> str:
+    """
+    Get the value to put in a dcc.Store element for the local dates [start_date, end_date) of all_bg_data.
+
+    If all_bg_data is in the server-side dataset store (server mode), this is only a view referencing it, so changing
+    the date range never copies or re-encodes the data. In binary and json modes the subset is serialized with
+    df_to_store_data, so the browser holds it as well as all_bg_data.
+
+    :param bg_data: value of the dcc.Store element holding all_bg_data
+    """
+    if is_dataset_handle(bg_data):
+        return make_dataset_view(bg_data, start_date, end_date)
+    return df_to_store_data(select_dates(all_bg_data, start_date, end_date))
+
+
+def select_dates(
+    all_bg_data: pd.DataFrame, start_date: datetime.date, end_date: datetime.date
+) -> pd.DataFrame:
+    """
+    :param all_bg_data: bg data sorted by datetime, and therefore by local date
+    :return: rows of all_bg_data on local dates [start_date, end_date), found by binary search on the date column
+    """
+    # date is local midnight as a naive datetime64, so search for Timestamps
+    start, end = all_bg_data["date"].searchsorted(
+        [pd.Timestamp(start_date), pd.Timestamp(end_date)]
+    )
+    return all_bg_data.iloc[start:end].copy(deep=False)
+
+
+def _encode_array(values, buffers: List[bytes], offset: int) -> dict:
+    # Copy to a contiguous array in native byte order, and record where it lives in the concatenated buffers
+    values = np.ascontiguousarray(values)
+    buffers.append(values.tobytes())
+    return {"dtype": values.dtype.str, "offset": offset, "count": len(values)}
+
+
+def _decode_array(spec: dict, data: bytearray) -> np.ndarray:
+    return np.frombuffer(
+        data, dtype=np.dtype(spec["dtype"]), count=spec["count"], offset=spec["offset"]
+    )
+
+
+def _encode_series(values: pd.Series, buffers: List[bytes], offset: int) -> dict:
+    dtype = values.dtype
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        utc = values.dt.tz_convert("UTC").dt.tz_localize(None)
+        return {
+            "kind": "datetime_utc",
+            **_encode_array(utc.values.view("int64"), buffers, offset),
+        }
+    if isinstance(dtype, pd.CategoricalDtype):
+        return {
+            "kind": "categorical",
+            "categories": dtype.categories.to_list(),
+            **_encode_array(values.cat.codes.to_numpy(), buffers, offset),
+        }
+    if dtype.kind in "biufM":
+        return {"kind": "numpy", **_encode_array(values.to_numpy(), buffers, offset)}
+    # Anything else (e.g. strings) falls back to a JSON list, with missing values as null
+    return {
+        "kind": "json",
+        "values": values.astype(object).where(values.notna(), None).to_list(),
+    }
+
+
+def _decode_series(spec: dict, data: bytearray):
+    if spec["kind"] == "json":
+        # As object dtype explicitly, or an empty column would come back as float64
+        return np.array(spec["values"], dtype=object)
+    values = _decode_array(spec, data)
+    if spec["kind"] == "datetime_utc":
+        return pd.DatetimeIndex(values.view("datetime64[ns]")).tz_localize("UTC").array
+    if spec["kind"] == "categorical":
+        return pd.Categorical.from_codes(values, categories=spec["categories"])
+    return values
+
+
+def df_to_binary(df: pd.DataFrame) -> str:
+    """
+    Serialize a DataFrame as zlib-compressed raw column buffers, base64-encoded so it can be stored in a dcc.Store.
+    Compared to JSON this keeps each column's dtype (numeric columns as-is, categoricals as codes plus categories,
+    tz-aware datetimes as int64 UTC nanoseconds) and decodes without any parsing; see binary_to_df.
+
+    :return: string starting with BINARY_PREFIX
+    """
+    buffers = []
+    offset = 0
+    columns = []
+    for name in list(df.columns) + [None]:
+        values = df.index.to_series() if name is None else df[name]
+        spec = _encode_series(values, buffers, offset)
+        offset += len(buffers[-1]) if "offset" in spec else 0
+        columns.append({"name": name, **spec})
+    header = json.dumps({"columns": columns[:-1], "index": columns[-1]}).encode()
+    payload = len(header).to_bytes(4, "little") + header + b"".join(buffers)
+    return BINARY_PREFIX + base64.b64encode(zlib.compress(payload, 1)).decode("ascii")
+
+
+def binary_to_df(binary: str) -> pd.DataFrame:
+    """
+    Convert the output of df_to_binary back to a DataFrame. Columns are read directly from the decompressed buffer
+    (no parsing or type inference). tz-aware datetime columns are returned in UTC.
+    """
+    payload = bytearray(zlib.decompress(base64.b64decode(binary[len(BINARY_PREFIX) :])))
+    header_length = int.from_bytes(payload[:4], "little")
+    header = json.loads(payload[4 : 4 + header_length])
+    data = memoryview(payload)[4 + header_length :]
+    df = pd.DataFrame(
+        {spec["name"]: _decode_series(spec, data) for spec in header["columns"]}
+    )
+    df.index = pd.Index(_decode_series(header["index"], data))
+    return df
+
+
+def is_binary_payload(value) -> bool:
+    return isinstance(value, str) and value.startswith(BINARY_PREFIX)
+
+
+class DecodeCache:
+    """
+    Memo of decoded dcc.Store payloads, keyed by a hash of the payload contents, so that several callbacks triggered
+    by the same Store update only decode it once per process.
+
+    Cached DataFrames are shared, so their underlying arrays are made read-only and every caller gets its own shallow
+    copy: adding or replacing columns only affects the caller's copy, and writing into existing values raises
+    instead of silently changing what other callbacks see. Least-recently-used entries are evicted once the decoded
+    frames take up more than max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get_or_decode(
+        self, key: str, decode: Callable[[], pd.DataFrame]
+    ) -> pd.DataFrame:
+        """
+        :param key: key from make_key
+        :param decode: function to produce the DataFrame if it is not cached
+        :return: shallow, read-only copy of the DataFrame for key
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0].copy(deep=False)
+            self.misses += 1
+        # Decode outside the lock; if two callbacks miss at once, both decode and the second insert wins
+        df = decode()
+        size_bytes = int(df.memory_usage(deep=True).sum())
+        df = make_read_only(df)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self.entries[key] = (df, size_bytes)
+            self.total_bytes += size_bytes
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+        return df.copy(deep=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+            }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+def make_read_only(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rebuild df on read-only arrays (including categorical codes and datetime values), so that modifying a cached frame
+    in place raises instead of changing what later callers get. Object columns are left writable, since some pandas
+    internals need a writable buffer to inspect them. The index is kept as is; pandas indexes are immutable.
+    """
+    columns = {}
+    for i, (_, column) in enumerate(df.items()):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            values = pd.Categorical.from_codes(
+                _lock(column.cat.codes.to_numpy()), dtype=column.dtype
+            )
+        elif isinstance(column.dtype, pd.DatetimeTZDtype):
+            # pandas can't wrap an existing array in a tz-aware column without copying it, so copy first: the copy
+            # owns its data, which can then be locked through a view of it
+            values = column.array.copy()
+            _lock(values.view("i8"))
+        elif isinstance(column.dtype, np.dtype) and column.dtype != object:
+            values = _lock(column.to_numpy())
+        else:
+            values = column.array
+        columns[i] = pd.Series(values, index=df.index, copy=False)
+    read_only = pd.DataFrame(columns, index=df.index, copy=False)
+    read_only.columns = df.columns
+    # Some pandas versions copy columns of the same type into one new 2D array here; lock that too
+    for _, column in read_only.items():
+        if isinstance(column.dtype, np.dtype) and column.dtype != object:
+            _lock(column.to_numpy())
+    return read_only
+
+
+def _lock(values: np.ndarray) -> np.ndarray:
+    """
+    Mark values, and the array it is a view of (if any), as read-only.
+    """
+    array = values
+    while isinstance(array, np.ndarray):
+        array.flags.writeable = False
+        array = array.base
+    return values
+
+
+_decode_cache = None
+_decode_cache_lock = threading.Lock()
+
+
+def get_decode_cache() -> DecodeCache:
+    """
+    Get the process-wide decode cache, with a size limit from the NIGHTSCOUT_DECODE_CACHE_MAX_MB environment variable
+    (defaults to 256; 0 disables caching across calls).
+    """
+    global _decode_cache
+    with _decode_cache_lock:
+        if _decode_cache is None:
+            max_mb = float(
+                os.getenv(
+                    "NIGHTSCOUT_DECODE_CACHE_MAX_MB",
+                    default=DEFAULT_DECODE_CACHE_MAX_MB,
+                )
+            )
+            _decode_cache = DecodeCache(max_bytes=int(max_mb * 1024 * 1024))
+        return _decode_cache
+
 
 def bg_data_json_to_df(bg_json: str, timezone_name: str) -> pd.DataFrame:
     """
-    Wrapper to convert from the BG JSON stored in the dcc.Store element back to a dataframe,
-    including tz-aware datetime values.
+    Wrapper to convert from the BG data stored in the dcc.Store element back to a dataframe,
+    including tz-aware datetime values. Decoded data is memoized (see DecodeCache), so treat the result as read-only:
+    adding columns is fine, but modify values only after taking a copy.
 
-    :param bg_json: JSON representation of bg data from Nightscout
+    :param bg_json: JSON representation of bg data from Nightscout, or a value from df_to_store_data
     :param timezone_name: string representing timezone to convert times to (times are stored in UTC in JSON)
-    :return: Pandas dataframe with tz-aware datetime column
+    :return: Pandas dataframe with tz-aware datetime column and the column types from apply_compact_schema
+    :raises DatasetNotFoundError: if bg_json is a handle (or view of a dataset) that is no longer available
     """
-    all_bg_data = pd.read_json(bg_json, orient="split")
-    all_bg_data["datetime"] = pd.to_datetime(
-        all_bg_data["datetime"], utc=True
-    ).dt.tz_convert(timezone_name)
+    if is_dataset_view(bg_json):
+        # Slice the (memoized) full dataset rather than caching each date range separately
+        handle, start_date, end_date = parse_dataset_view(bg_json)
+        return select_dates(
+            bg_data_json_to_df(handle, timezone_name), start_date, end_date
+        )
+    return get_decode_cache().get_or_decode(
+        DecodeCache.make_key("bg", timezone_name, bg_json),
+        lambda: _decode_bg_data(bg_json, timezone_name),
+    )
+
+
+def bg_data_json_to_daily_histogram(bg_json: str, timezone_name: str) -> pd.DataFrame:
+    """
+    Get the daily_cumulative_histogram of the CGM readings in bg data stored in a dcc.Store element. Memoized like
+    bg_data_json_to_df; for a view of a stored dataset, the histogram of the whole dataset is built once and the
+    view's dates are selected from it, so changing the date range doesn't go back to the readings.
+
+    :param bg_json: value from df_to_store_data or subset_to_store_data
+    :param timezone_name: string representing timezone to convert times to
+    :return: DataFrame as returned by daily_cumulative_histogram (read-only, as for bg_data_json_to_df)
+    :raises DatasetNotFoundError: if bg_json is a handle (or view of a dataset) that is no longer available
+    """
+    if is_dataset_view(bg_json):
+        handle, start_date, end_date = parse_dataset_view(bg_json)
+        histogram = bg_data_json_to_daily_histogram(handle, timezone_name)
+        start, end = histogram.index.searchsorted(
+            [pd.Timestamp(start_date), pd.Timestamp(end_date)]
+        )
+        return histogram.iloc[start:end]
+
+    def build_histogram() -> pd.DataFrame:
+        all_bg_data = bg_data_json_to_df(bg_json, timezone_name)
+        cgm_data = all_bg_data.loc[all_bg_data["eventType"] == "sgv"]
+        return daily_cumulative_histogram(cgm_data["bg"], cgm_data["date"])
+
+    return get_decode_cache().get_or_decode(
+        DecodeCache.make_key("bg_histogram", timezone_name, bg_json), build_histogram
+    )
+
+
+def bg_data_json_to_site_change_accumulators(
+    bg_json: str, timezone_name: str
+) -> pd.DataFrame:
+    """
+    Get the site_change_accumulators of bg data stored in a dcc.Store element, memoized like bg_data_json_to_df, so
+    changing the bin width or graph style doesn't realign the readings with site changes.
+
+    :param bg_json: value from df_to_store_data or subset_to_store_data
+    :param timezone_name: string representing timezone to convert times to (hours of day are local)
+    :return: DataFrame as returned by site_change_accumulators (read-only, as for bg_data_json_to_df)
+    :raises DatasetNotFoundError: if bg_json is a handle (or view of a dataset) that is no longer available
+    """
+    return get_decode_cache().get_or_decode(
+        DecodeCache.make_key("site_change", timezone_name, bg_json),
+        lambda: site_change_accumulators(bg_data_json_to_df(bg_json, timezone_name)),
+    )
+
+
+def hash_df(df: pd.DataFrame) -> str:
+    """
+    :return: hash of the column names and values of df (not its index), for use in cache keys
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([str(column) for column in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_basal_per_hour_memoized(
+    all_bg_data: pd.DataFrame,
+    profiles: pd.DataFrame,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    timezone_name: str,
+) -> pd.DataFrame:
+    """
+    get_basal_per_hour, memoized in the decode cache (so within its memory limit) by a hash of everything the result
+    depends on: the temp basal and automatic bolus rows, the profiles, the date range and the timezone. Revisiting a
+    date range, or reloading data without new basal events, reuses the earlier result. Treat the result as
+    read-only, as for bg_data_json_to_df.
+    """
+    basal_rows = all_bg_data.loc[
+        (all_bg_data["duration"].notna() & all_bg_data["absolute"].notna())
+        | (
+            all_bg_data["insulin"].notna()
+            & (all_bg_data["notes"] == "Automatic Bolus/Correction")
+        ),
+        BASAL_INPUT_COLUMNS,
+    ]
+    return get_decode_cache().get_or_decode(
+        DecodeCache.make_key(
+            "basal_per_hour",
+            timezone_name,
+            str(start_date),
+            str(end_date),
+            hash_df(basal_rows),
+            hash_df(profiles),
+        ),
+        lambda: get_basal_per_hour(
+            all_bg_data, profiles, start_date, end_date, timezone_name
+        ),
+    )
+
+
+def _decode_bg_data(bg_json: str, timezone_name: str) -> pd.DataFrame:
+    if is_dataset_handle(bg_json):
+        all_bg_data = get_dataset_store().get(bg_json)
+    elif is_binary_payload(bg_json):
+        all_bg_data = binary_to_df(bg_json)
+    else:
+        all_bg_data = pd.read_json(bg_json, orient="split")
+        all_bg_data["datetime"] = pd.to_datetime(all_bg_data["datetime"], utc=True)
+        apply_compact_schema(all_bg_data)
+    all_bg_data["datetime"] = all_bg_data["datetime"].dt.tz_convert(timezone_name)
     return all_bg_data
 
 
 def profile_json_to_df(profile_json: str, timezone_name: str) -> pd.DataFrame:
     """
     Wrapper to convert from the profile JSON stored in the dcc.Store element back to a dataframe,
-    including tz-aware datetime values.
+    including tz-aware datetime values. Memoized like bg_data_json_to_df, so treat the result as read-only.
 
-    :param profile_json: JSON representation of profile data from Nightscout
+    :param profile_json: JSON representation of profile data from Nightscout, or a value from df_to_store_data
     :param timezone_name: string representing timezone to convert times to (times are stored in UTC in JSON)
     :return: Pandas dataframe with tz-aware profile_start_datetime column
+    :raises DatasetNotFoundError: if profile_json is a handle to a dataset that is no longer available
     """
-    profiles = pd.read_json(profile_json, orient="split")
-    profiles["profile_start_datetime"] = pd.to_datetime(
-        profiles["profile_start_datetime"], utc=True
-    ).dt.tz_convert(timezone_name)
+    return get_decode_cache().get_or_decode(
+        DecodeCache.make_key("profile", timezone_name, profile_json),
+        lambda: _decode_profile_data(profile_json, timezone_name),
+    )
+
+
+def _decode_profile_data(profile_json: str, timezone_name: str) -> pd.DataFrame:
+    if is_dataset_handle(profile_json):
+        profiles = get_dataset_store().get(profile_json)
+    elif is_binary_payload(profile_json):
+        profiles = binary_to_df(profile_json)
+    else:
+        profiles = pd.read_json(profile_json, orient="split")
+        profiles["profile_start_datetime"] = pd.to_datetime(
+            profiles["profile_start_datetime"], utc=True
+        )
+    profiles["profile_start_datetime"] = profiles[
+        "profile_start_datetime"
+    ].dt.tz_convert(timezone_name)
     return profiles
 
 
@@ -0,0 +1,258 @@
+import collections
+import datetime
+import json
+import os
+import pickle
+import threading
+import uuid
+from typing import Optional, Tuple
+
+import pandas as pd
+
+from nightscout_dash.background import background_callbacks_enabled, get_background_dir
+
+# Prefix marking a dcc.Store value as a handle into the DatasetStore rather than serialized data
+HANDLE_PREFIX = "dataset:"
+# Prefix marking a dcc.Store value as a date range of a stored dataset (see make_dataset_view)
+VIEW_PREFIX = "view:"
+DEFAULT_MAX_MB = 1024
+DEFAULT_SPILL_MAX_MB = 4096
+
+
+class DatasetNotFoundError(KeyError):
+    """
+    Raised when a handle refers to a dataset that is no longer available, e.g. because it was evicted without a spill
+    directory, or was stored by a different server process.
+    """
+
+
+def is_dataset_handle(value) -> bool:
+    return isinstance(value, str) and value.startswith(HANDLE_PREFIX)
+
+
+def make_dataset_view(
+    handle: str, start_date: datetime.date, end_date: datetime.date
+) -> str:
+    """
+    :return: dcc.Store value referring to the local dates [start_date, end_date) of the dataset stored under handle,
+        without storing another copy of the data
+    """
+    return VIEW_PREFIX + json.dumps(
+        [handle, start_date.isoformat(), end_date.isoformat()]
+    )
+
+
+def is_dataset_view(value) -> bool:
+    return isinstance(value, str) and value.startswith(VIEW_PREFIX)
+
+
+def parse_dataset_view(view: str) -> Tuple[str, datetime.date, datetime.date]:
+    """
+    :return: tuple of (handle, start_date, end_date) passed to make_dataset_view
+    """
+    handle, start_date, end_date = json.loads(view[len(VIEW_PREFIX) :])
+    return (
+        handle,
+        datetime.date.fromisoformat(start_date),
+        datetime.date.fromisoformat(end_date),
+    )
+
+
+class DatasetStore:
+    """
+    Server-side registry of DataFrames, so dcc.Store elements only need to carry a short handle instead of the data
+    itself.
+
+    Datasets are kept in memory up to max_bytes, evicting the least-recently-used first. If spill_dir is set, evicted
+    datasets are written there and read back (and made most-recently-used again) the next time they are requested.
+    With write_through, every dataset is written to spill_dir as soon as it is stored, so other processes sharing
+    spill_dir (e.g. background callback workers and the web server) can read it, and a dataset discarded by any of
+    them is dropped from the others' memory too.
+    Stored DataFrames are never handed out directly: get returns a copy, so callbacks can modify it freely.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        spill_dir: Optional[str] = None,
+        write_through: bool = False,
+        max_spill_bytes: int = DEFAULT_SPILL_MAX_MB * 1024 * 1024,
+    ):
+        """
+        :param max_bytes: maximum in-memory size of all datasets before eviction
+        :param spill_dir: directory to write evicted datasets to (created if needed); None to discard them
+        :param write_through: write datasets to spill_dir when stored, not only when evicted
+        :param max_spill_bytes: maximum size of spill_dir; least-recently-used files beyond this are deleted
+        """
+        if write_through and not spill_dir:
+            raise ValueError("write_through requires a spill_dir")
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.write_through = write_through
+        self.max_spill_bytes = max_spill_bytes
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.datasets = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, df: pd.DataFrame) -> str:
+        """
+        Store a DataFrame. The store keeps its own copy, so later changes to df are not reflected.
+
+        :return: handle to store in a dcc.Store and later pass to get
+        """
+        handle = HANDLE_PREFIX + uuid.uuid4().hex
+        df = df.copy()
+        if self.write_through:
+            self._spill(handle, df)
+        self._insert(handle, df)
+        return handle
+
+    def get(self, handle: str) -> pd.DataFrame:
+        """
+        :return: a copy of the DataFrame stored under handle
+        :raises DatasetNotFoundError: if the dataset is no longer available
+        """
+        with self.lock:
+            entry = self.datasets.get(handle)
+            if entry is not None and self.write_through:
+                try:
+                    # Mark as recently used, for _prune_spill_dir
+                    os.utime(self._spill_path(handle))
+                except FileNotFoundError:
+                    # Discarded by another process
+                    self.datasets.pop(handle)
+                    self.total_bytes -= entry[1]
+                    raise DatasetNotFoundError(handle)
+            if entry is not None:
+                self.datasets.move_to_end(handle)
+                return entry[0].copy()
+        df = self._read_spilled(handle)
+        self._insert(handle, df)
+        return df.copy()
+
+    def discard(self, handle: str) -> None:
+        """
+        Forget a dataset that is no longer needed, in memory and on disk.
+        """
+        with self.lock:
+            entry = self.datasets.pop(handle, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+        if self.spill_dir:
+            try:
+                os.remove(self._spill_path(handle))
+            except FileNotFoundError:
+                pass
+
+    def _insert(self, handle: str, df: pd.DataFrame) -> None:
+        size_bytes = int(df.memory_usage(deep=True).sum())
+        with self.lock:
+            if self.write_through:
+                self._forget_discarded()
+            self.datasets[handle] = (df, size_bytes)
+            self.total_bytes += size_bytes
+            evicted = []
+            # Always keep the newest dataset, even if it alone exceeds max_bytes
+            while self.total_bytes > self.max_bytes and len(self.datasets) > 1:
+                evicted_handle, (evicted_df, evicted_bytes) = self.datasets.popitem(
+                    last=False
+                )
+                self.total_bytes -= evicted_bytes
+                evicted.append((evicted_handle, evicted_df))
+        for evicted_handle, evicted_df in evicted:
+            self._spill(evicted_handle, evicted_df)
+
+    def _forget_discarded(self) -> None:
+        """
+        Drop in-memory datasets whose write-through files have been removed, i.e. discarded by another process (or
+        pruned from spill_dir). Must be called with the lock held.
+        """
+        for handle in [
+            handle
+            for handle in self.datasets
+            if not os.path.exists(self._spill_path(handle))
+        ]:
+            _, size_bytes = self.datasets.pop(handle)
+            self.total_bytes -= size_bytes
+
+    def _spill_path(self, handle: str) -> str:
+        return os.path.join(self.spill_dir, handle[len(HANDLE_PREFIX) :] + ".pickle")
+
+    def _spill(self, handle: str, df: pd.DataFrame) -> None:
+        if not self.spill_dir:
+            return
+        path = self._spill_path(handle)
+        if os.path.exists(path):
+            return
+        # Write then rename, so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self._prune_spill_dir()
+
+    def _read_spilled(self, handle: str) -> pd.DataFrame:
+        if self.spill_dir:
+            path = self._spill_path(handle)
+            try:
+                with open(path, "rb") as f:
+                    df = pickle.load(f)
+                # Mark as recently used, for _prune_spill_dir
+                os.utime(path)
+                return df
+            except FileNotFoundError:
+                pass
+        raise DatasetNotFoundError(handle)
+
+    def _prune_spill_dir(self) -> None:
+        files = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(".pickle"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_bytes <= self.max_spill_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_dataset_store() -> DatasetStore:
+    """
+    Get the process-wide dataset store configured by environment variables:
+        * NIGHTSCOUT_STORE_MAX_MB: maximum in-memory size of stored datasets in MB (defaults to 1024)
+        * NIGHTSCOUT_STORE_SPILL_DIR: directory to write evicted datasets to (defaults to none; evicted datasets are
+          discarded and reloaded from Nightscout when next needed)
+        * NIGHTSCOUT_STORE_SPILL_MAX_MB: maximum size of the spill directory in MB (defaults to 4096)
+
+    When background callbacks are enabled, datasets are created in worker processes, so they are always written
+    through to the spill directory (defaulting to a "datasets" directory next to the background job queue).
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            max_mb = float(os.getenv("NIGHTSCOUT_STORE_MAX_MB", default=DEFAULT_MAX_MB))
+            spill_max_mb = float(
+                os.getenv("NIGHTSCOUT_STORE_SPILL_MAX_MB", default=DEFAULT_SPILL_MAX_MB)
+            )
+            spill_dir = os.getenv("NIGHTSCOUT_STORE_SPILL_DIR") or None
+            write_through = background_callbacks_enabled()
+            if write_through and not spill_dir:
+                spill_dir = os.path.join(get_background_dir(), "datasets")
+            _default_store = DatasetStore(
+                max_bytes=int(max_mb * 1024 * 1024),
+                spill_dir=spill_dir,
+                write_through=write_through,
+                max_spill_bytes=int(spill_max_mb * 1024 * 1024),
+            )
+        return _default_store
@@ -3,6 +3,7 @@ from nightscout_loader import (
     fetch_nightscout_data,
     fetch_profile_data,
 )
+from nightscout_dash.analysis_utils import find_distinct_lows
 from nightscout_dash.plot_utils import add_light_style
 
 from datetime import date
@@ -44,17 +45,9 @@ n_recovered_pts_between_lows = 5
 
 cgm_data = all_bg_data.loc[all_bg_data["eventType"] == "sgv"]
 
-cgm_data["recovered_point_count"] = (cgm_data["bg"] > recovered_threshold).cumsum()
-cgm_data["is_distinct_low"] = False
-n_recovered_points_at_last_low = -n_recovered_pts_between_lows
-for index, row in cgm_data.loc[cgm_data["bg"] <= low_threshold].iterrows():
-    is_distinct_low = (
-        row["recovered_point_count"]
-        >= n_recovered_points_at_last_low + n_recovered_pts_between_lows
-    )
-    if is_distinct_low:
-        n_recovered_points_at_last_low = row["recovered_point_count"]
-        cgm_data.loc[index, "is_distinct_low"] = True
+cgm_data["is_distinct_low"] = find_distinct_lows(
+    cgm_data["bg"], low_threshold, recovered_threshold, n_recovered_pts_between_lows
+)
 
 # Get number per day
 cgm_by_date = cgm_data.groupby("date")
@@ -91,9 +91,11 @@ def generate_ns_layout():
             dcc.Store(id="all-bg-data"),
             dcc.Store(id="subset-bg-data"),
             dcc.Store(id="first-load-dummy"),
-            dcc.Store(id="already-loaded-dates"),
+            dcc.Store(id="loaded-coverage"),
             dcc.Store(id="profile-data"),
-            dcc.Store(id="loaded-nightscout-url"),
+            dcc.Store(id="subset-date-range"),
+            dcc.Store(id="basal-rate-figures"),
+            dcc.Store(id="site-change-figures"),
         ]
     )
 
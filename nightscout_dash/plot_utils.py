@@ -1,3 +1,13 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Roughly two points per horizontal pixel of a full-width graph
+DEFAULT_MAX_POINTS = 4000
+# Above this many points, render with WebGL (Scattergl) rather than SVG
+WEBGL_THRESHOLD = 2000
+
+
 def add_light_style(fig) -> None:
     """
     Add some basic common styling to a figure for a consistent look across graphs.
@@ -22,3 +32,45 @@ def add_light_style(fig) -> None:
         gridcolor="rgba(.9,.9,.9,1)",
         gridwidth=0.5,
     )
+
+
+def downsample_min_max(
+    x: pd.Series, y: pd.Series, max_points: int = DEFAULT_MAX_POINTS
+) -> np.ndarray:
+    """
+    Choose at most max_points points that preserve the visible shape of a scatter plot, by dividing the x range into
+    equal-width buckets and keeping the lowest and highest point in each. Unlike keeping every nth point, this never
+    drops a peak or a trough.
+
+    :param x: x values (numbers or datetimes), sorted ascending
+    :param y: y values; points with missing y are dropped
+    :param max_points: point budget
+    :return: positional indices of the points to keep, in ascending order
+    """
+    y = np.asarray(y, dtype=float)
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) <= max_points:
+        return valid
+    if pd.api.types.is_datetime64_any_dtype(x):
+        x = x.to_numpy("datetime64[ns]").view("int64")
+    x = np.asarray(x, dtype=float)[valid]
+    y = y[valid]
+
+    n_buckets = max(max_points // 2, 1)
+    x_range = max(x[-1] - x[0], 1)
+    buckets = np.minimum(
+        ((x - x[0]) * (n_buckets / x_range)).astype(np.int64), n_buckets - 1
+    )
+    # Order by bucket, then y: the first and last point of each bucket's run are its minimum and maximum
+    order = np.lexsort((y, buckets))
+    sorted_buckets = buckets[order]
+    firsts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+    lasts = np.r_[firsts[1:] - 1, len(order) - 1]
+    return valid[np.unique(np.r_[order[firsts], order[lasts]])]
+
+
+def scatter_trace_type(n_points: int):
+    """
+    :return: go.Scattergl for large traces, which SVG (go.Scatter) renders slowly, otherwise go.Scatter
+    """
+    return go.Scattergl if n_points > WEBGL_THRESHOLD else go.Scatter
@@ -5,8 +5,10 @@ from dash import (
     Output,
     State,
     callback,
+    ctx,
     no_update,
 )
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import datetime
 import json
@@ -15,22 +17,49 @@ import pandas as pd
 import plotly.graph_objects as go
 import os
 import requests.exceptions
+import time
 import tzlocal
 import zoneinfo
-from urllib.parse import urlparse, urlsplit
 
 
 from nightscout_dash.data_utils import (
     bg_data_json_to_df,
+    df_to_store_data,
     profile_json_to_df,
+    release_store_data,
+    subset_to_store_data,
     AnalysisComponent,
 )
-from nightscout_dash.plot_utils import add_light_style
+from nightscout_dash.background import get_background_callback_manager
+from nightscout_dash.coverage_index import CoverageIndex
+from nightscout_dash.dataset_store import DatasetNotFoundError
+from nightscout_dash.plot_utils import (
+    add_light_style,
+    downsample_min_max,
+    scatter_trace_type,
+)
+from nightscout_cache import get_default_cache
 from nightscout_loader import (
-    fetch_nightscout_data,
-    fetch_profile_data,
+    NightscoutClient,
+    merge_sorted,
+    normalize_nightscout_url,
+    replace_tail,
 )
 
+# Refetch data from this long before the latest loaded record when refreshing, in case of late uploads
+REFRESH_OVERLAP = datetime.timedelta(hours=1)
+DEFAULT_REFRESH_SECONDS = 300
+
+
+def get_refresh_seconds() -> float:
+    """
+    How often to refresh today's data when auto-refresh is on, from the NIGHTSCOUT_REFRESH_SECONDS environment
+    variable (defaults to 300).
+    """
+    return float(
+        os.getenv("NIGHTSCOUT_REFRESH_SECONDS", default=DEFAULT_REFRESH_SECONDS)
+    )
+
 
 class DataUpdater(AnalysisComponent):
     @property
@@ -96,6 +125,12 @@ class DataUpdater(AnalysisComponent):
             ),
             dbc.Row(
                 [
+                    dbc.Switch(
+                        id="auto-refresh",
+                        label="Keep today's data up to date",
+                        value=False,
+                        className="w-auto",
+                    ),
                     dbc.Button(
                         "Submit",
                         outline=True,
@@ -105,6 +140,20 @@ class DataUpdater(AnalysisComponent):
                     ),
                 ]
             ),
+            dcc.Interval(
+                id="refresh-interval",
+                interval=get_refresh_seconds() * 1000,
+                max_intervals=0,
+            ),
+            # Only shown while loading in a background callback (see register_callbacks)
+            dbc.Progress(
+                id="load-progress",
+                value=0,
+                striped=True,
+                animated=True,
+                className="mt-2",
+                style={"display": "none"},
+            ),
             dbc.Spinner(
                 dcc.Graph(
                     id="loaded-data-graph",
@@ -115,7 +164,7 @@ class DataUpdater(AnalysisComponent):
 
     @staticmethod
     def register_callbacks():
-        @callback(
+        load_callback_spec = dict(
             output={
                 "bg_data": Output(
                     component_id="all-bg-data", component_property="data"
@@ -123,33 +172,38 @@ class DataUpdater(AnalysisComponent):
                 "subset_data": Output(
                     component_id="subset-bg-data", component_property="data"
                 ),
-                "already_loaded_date_strs": Output(
-                    component_id="already-loaded-dates",
-                    component_property="data",
+                "loaded_coverage": Output(
+                    component_id="loaded-coverage", component_property="data"
                 ),
                 "profile_data": Output(
                     component_id="profile-data", component_property="data"
                 ),
-                "loaded_nightscout_url": Output(
-                    component_id="loaded-nightscout-url", component_property="data"
-                ),
                 "nightscout_error_open": Output(
                     component_id="nightscout-error",
                     component_property="is_open",
                 ),
+                "subset_date_range": Output(
+                    component_id="subset-date-range", component_property="data"
+                ),
             },
             inputs={
                 "submit_button": Input(
                     component_id="submit-button", component_property="n_clicks"
                 ),
+                "refresh_intervals": Input(
+                    component_id="refresh-interval", component_property="n_intervals"
+                ),
+                "subset_date_range": State(
+                    component_id="subset-date-range", component_property="data"
+                ),
                 "start_date_str": State(
                     component_id="data-date-range", component_property="start_date"
                 ),
                 "end_date_str": State(
                     component_id="data-date-range", component_property="end_date"
                 ),
-                "already_loaded_date_strs": State(
-                    component_id="already-loaded-dates", component_property="data"
+                "loaded_coverage": State(
+                    component_id="loaded-coverage", component_property="data"
                 ),
                 "bg_data": State(component_id="all-bg-data", component_property="data"),
                 "profile_json": State(
@@ -161,144 +215,224 @@ class DataUpdater(AnalysisComponent):
                 "nightscout_url": State(
                     component_id="nightscout-url", component_property="value"
                 ),
-                "loaded_nightscout_url": State(
-                    component_id="loaded-nightscout-url", component_property="data"
-                ),
             },
         )
+
         def load_nightscout_data(
+            set_progress,
             submit_button,
+            refresh_intervals,
+            subset_date_range,
             start_date_str,
             end_date_str,
-            already_loaded_date_strs,
+            loaded_coverage,
             bg_data,
             profile_json,
             timezone_name: str,
             nightscout_url: str,
-            loaded_nightscout_url: str,
         ):
+            """
+            :param set_progress: function to report (percent, label) to the load-progress bar, or None if not running
+                as a background callback
+            """
             # TODO: if start date or end date are None, gentle error
+            coverage = (
+                CoverageIndex.from_json(loaded_coverage) if loaded_coverage else None
+            )
+            is_refresh = ctx.triggered_id == "refresh-interval"
+            if is_refresh:
+                # Refresh what was last loaded, not whatever is currently selected but not yet submitted
+                if subset_date_range is None or coverage is None:
+                    raise PreventUpdate
+                start_date_str, end_date_str = json.loads(subset_date_range)
+                nightscout_url = coverage.nightscout_url
+                timezone_name = coverage.timezone_name
 
-            # Ensure that the URL starts with http:// or https://
-            parsed_url = urlsplit(nightscout_url)
-            if not parsed_url.scheme:
-                nightscout_url = "https://" + nightscout_url
+            # Normalize the URL so we don't treat it as an actual change if e.g. a trailing slash is added/removed
+            nightscout_url = normalize_nightscout_url(nightscout_url)
+            cache = get_default_cache()
+            error_result = {key: no_update for key in load_callback_spec["output"]}
+            error_result["nightscout_error_open"] = True
 
-            # Extract the root URL and remove any trailing slash so we don't treat it as an actual change if a
-            # trailing slash is added/removed
-            parsed_url = urlparse(nightscout_url)
-            nightscout_url = f"{parsed_url.scheme}://{parsed_url.netloc}".rstrip("/")
+            def report_progress(n_days_done: int, n_days_total: int):
+                if set_progress:
+                    set_progress(
+                        [
+                            100 * n_days_done / max(n_days_total, 1),
+                            f"{n_days_done}/{n_days_total} days",
+                        ]
+                    )
 
-            # First find out what range of data we actually need to fetch from the server, if any
-            requested_dates = pd.date_range(
-                start=datetime.date.fromisoformat(start_date_str),
-                end=datetime.date.fromisoformat(end_date_str),
+            # Requested local dates, as a half-open interval
+            start_date = datetime.date.fromisoformat(start_date_str)
+            end_date = datetime.date.fromisoformat(end_date_str) + datetime.timedelta(
+                days=1
             )
 
-            # If we don't already have data loaded, just load this start-end date
-            if (already_loaded_date_strs is None) or (
-                loaded_nightscout_url != nightscout_url
-            ):
+            all_bg_data = None
+            # Local dates depend on the timezone, so data loaded in another timezone can't be extended
+            if coverage is not None and coverage.matches(nightscout_url, timezone_name):
+                try:
+                    all_bg_data = bg_data_json_to_df(bg_data, timezone_name)
+                    profiles = profile_json_to_df(profile_json, timezone_name)
+                except DatasetNotFoundError:
+                    # Evicted from the server-side store (or stored by another server process): start over
+                    all_bg_data = None
 
+            # If we don't already have data loaded, just load this start-end date
+            if all_bg_data is None:
+                fetched_at = time.time()
                 try:
-                    all_bg_data = fetch_nightscout_data(
-                        nightscout_url,
-                        datetime.date.fromisoformat(start_date_str),
-                        datetime.date.fromisoformat(end_date_str)
-                        + datetime.timedelta(days=1),
-                        local_timezone_name=timezone_name,
-                    )
-                    profiles = fetch_profile_data(nightscout_url, timezone_name)
-                except requests.exceptions.JSONDecodeError:
-                    return {
-                        "bg_data": no_update,
-                        "subset_data": no_update,
-                        "already_loaded_date_strs": no_update,
-                        "profile_data": no_update,
-                        "loaded_nightscout_url": no_update,
-                        "nightscout_error_open": True,
-                    }
-                already_loaded_dates = requested_dates
-                updated_bg_data = all_bg_data.to_json(orient="split", date_unit="ns")
+                    with NightscoutClient(nightscout_url, cache=cache) as client:
+                        all_bg_data, profiles = client.fetch_data_and_profiles(
+                            start_date,
+                            end_date,
+                            local_timezone_name=timezone_name,
+                            progress_callback=report_progress,
+                        )
+                except requests.exceptions.RequestException:
+                    return error_result
+                coverage = CoverageIndex(nightscout_url, timezone_name)
+                coverage.add(start_date, end_date, fetched_at)
+                updated_bg_data = df_to_store_data(all_bg_data)
+                updated_profile_data = df_to_store_data(profiles)
 
             else:
-                all_bg_data = bg_data_json_to_df(bg_data, timezone_name)
-                profiles = profile_json_to_df(profile_json, timezone_name)
-
-                # Check what dates we have already
-                already_loaded_dates = pd.read_json(
-                    already_loaded_date_strs, typ="series"
-                )
-                # See which requested dates are new
-                new_dates = set(requested_dates) - set(already_loaded_dates)
-                # TODO: If today is requested, always load it again.
-
-                if len(new_dates):
-                    # Break into contiguous segments
-                    new_dates = sorted(list(new_dates))
-                    jump_start_indices = (
-                        np.flatnonzero(
-                            (np.array(new_dates[1:]) - np.array(new_dates[0:-1]))
-                            > datetime.timedelta(days=1)
-                        )
-                        + 1
-                    )
-                    segment_start_indices = np.insert(jump_start_indices, 0, 0)
-                    segment_end_indices = np.append(
-                        jump_start_indices - 1, [len(new_dates) - 1]
+                today = datetime.datetime.now(zoneinfo.ZoneInfo(timezone_name)).date()
+                # Fetch dates we don't have yet, and refetch dates that were loaded before they were over (e.g.
+                # yesterday, if it was loaded yesterday). Today is brought up to date below rather than refetched.
+                missing = coverage.missing(start_date, end_date)
+                stale = [
+                    (stale_start, min(stale_end, today))
+                    for stale_start, stale_end in coverage.incomplete(
+                        start_date, end_date
                     )
+                    if stale_start < today
+                ]
+                # If today is requested and already loaded, fetch anything recorded since the latest data we have
+                refresh_tail = start_date <= today < end_date and not coverage.missing(
+                    today, today + datetime.timedelta(days=1)
+                )
+                if is_refresh and not (refresh_tail or stale):
+                    raise PreventUpdate
+                updated_bg_data = no_update
+                updated_profile_data = no_update
 
-                    new_bg_dataframes = [all_bg_data]
+                fetch_intervals = sorted(missing + stale)
+                if fetch_intervals:
+                    fetched_at = time.time()
+                    dates_to_fetch = [
+                        interval_start + datetime.timedelta(days=i)
+                        for interval_start, interval_end in fetch_intervals
+                        for i in range((interval_end - interval_start).days)
+                    ]
                     try:
-                        for (i_start, i_end) in zip(
-                            segment_start_indices, segment_end_indices
-                        ):
-                            new_bg_dataframes.append(
-                                fetch_nightscout_data(
-                                    nightscout_url,
-                                    new_dates[i_start],
-                                    new_dates[i_end] + datetime.timedelta(days=1),
-                                    local_timezone_name=timezone_name,
-                                )
+                        # Gaps between already-loaded ranges are fetched together, sharing one pool of requests
+                        with NightscoutClient(nightscout_url, cache=cache) as client:
+                            new_bg_data = client.fetch_dates(
+                                dates_to_fetch,
+                                local_timezone_name=timezone_name,
+                                progress_callback=report_progress,
                             )
-                    except requests.exceptions.JSONDecodeError:
-                        return {
-                            "bg_data": no_update,
-                            "subset_data": no_update,
-                            "already_loaded_date_strs": no_update,
-                            "profile_data": no_update,
-                            "loaded_nightscout_url": no_update,
-                            "nightscout_error_open": True,
-                        }
-                    all_bg_data = pd.concat(new_bg_dataframes)
-                    all_bg_data.sort_values(by="datetime", inplace=True)
-                    updated_bg_data = all_bg_data.to_json(
-                        orient="split", date_unit="ns"
-                    )
+                    except requests.exceptions.RequestException:
+                        return error_result
+                    if stale:
+                        # Drop what we had for the refetched dates
+                        all_bg_data = all_bg_data[
+                            ~all_bg_data["date"].isin(pd.DatetimeIndex(dates_to_fetch))
+                        ]
+                    # Both are already sorted by datetime, so merge rather than re-sort
+                    all_bg_data = merge_sorted(all_bg_data, new_bg_data, timezone_name)
+                    updated_bg_data = df_to_store_data(all_bg_data)
+                    for interval_start, interval_end in fetch_intervals:
+                        coverage.add(interval_start, interval_end, fetched_at)
 
-                    already_loaded_dates = pd.concat(
-                        [already_loaded_dates, pd.Series(new_dates)]
-                    )
-                else:
-                    updated_bg_data = no_update
-
-            all_bg_data["date"] = pd.to_datetime(all_bg_data["date"]).dt.date
-            subset_data = all_bg_data[
-                (all_bg_data["date"] >= datetime.date.fromisoformat(start_date_str))
-                & (all_bg_data["date"] <= datetime.date.fromisoformat(end_date_str))
-            ]
+                if refresh_tail:
+                    # Go by the latest CGM reading rather than the latest record: a treatment entered with a future time
+                    # would otherwise move since past readings that haven't arrived yet, and they'd never be fetched
+                    cgm_datetimes = all_bg_data["datetime"][
+                        all_bg_data["eventType"] == "sgv"
+                    ]
+                    if len(cgm_datetimes):
+                        since = (
+                            min(
+                                cgm_datetimes.iloc[-1],
+                                pd.Timestamp.now(tz=timezone_name),
+                            )
+                            - REFRESH_OVERLAP
+                        )
+                    else:
+                        since = pd.Timestamp(today).tz_localize(timezone_name)
+                    fetched_at = time.time()
+                    try:
+                        with NightscoutClient(nightscout_url) as client:
+                            tail = client.fetch_since(since, timezone_name)
+                    except requests.exceptions.RequestException:
+                        return error_result
+                    all_bg_data = replace_tail(all_bg_data, tail, since, timezone_name)
+                    updated_bg_data = df_to_store_data(all_bg_data)
+                    coverage.add(today, today + datetime.timedelta(days=1), fetched_at)
 
+            subset_data = subset_to_store_data(
+                bg_data if updated_bg_data is no_update else updated_bg_data,
+                all_bg_data,
+                start_date,
+                end_date,
+            )
+            # The old datasets are only referenced by the stores being replaced here (subset-bg-data is a view of
+            # all-bg-data), so they can be freed now rather than waiting to be evicted
+            release_store_data(bg_data, updated_bg_data)
+            release_store_data(profile_json, updated_profile_data)
             return {
                 "bg_data": updated_bg_data,
-                "subset_data": subset_data.to_json(orient="split", date_unit="ns"),
-                "already_loaded_date_strs": json.dumps(
-                    already_loaded_dates.astype("string").to_list()
-                ),
-                "profile_data": profiles.to_json(orient="split", date_unit="ns"),
-                "loaded_nightscout_url": nightscout_url,
+                "subset_data": subset_data,
+                "loaded_coverage": coverage.to_json(),
+                "profile_data": updated_profile_data,
                 "nightscout_error_open": False,
+                "subset_date_range": json.dumps([start_date_str, end_date_str]),
             }
 
+        # Loading can take a while for long date ranges, so optionally run it in a background process instead of
+        # tying up a web server worker. Dash cancels a running job when the callback is triggered again (e.g. the user
+        # resubmits), and the progress bar shows how many days have been loaded so far.
+        background_callback_manager = get_background_callback_manager()
+        if background_callback_manager:
+            callback(
+                **load_callback_spec,
+                background=True,
+                manager=background_callback_manager,
+                progress=[
+                    Output("load-progress", "value"),
+                    Output("load-progress", "label"),
+                ],
+                progress_default=[0, ""],
+                running=[
+                    (
+                        Output("load-progress", "style"),
+                        {"display": "flex"},
+                        {"display": "none"},
+                    ),
+                    # A refresh while loading would cancel the load
+                    (Output("refresh-interval", "disabled"), True, False),
+                ],
+            )(load_nightscout_data)
+        else:
+
+            @callback(**load_callback_spec)
+            def load_nightscout_data_in_request(**kwargs):
+                return load_nightscout_data(None, **kwargs)
+
+        @callback(
+            output={
+                "max_intervals": Output("refresh-interval", "max_intervals"),
+            },
+            inputs={
+                "auto_refresh": Input("auto-refresh", "value"),
+            },
+        )
+        def toggle_auto_refresh(auto_refresh):
+            return {"max_intervals": -1 if auto_refresh else 0}
+
         @callback(
             output={
                 "graph": Output("loaded-data-graph", "figure"),
@@ -316,18 +450,21 @@ class DataUpdater(AnalysisComponent):
             else:
                 df = bg_data_json_to_df(bg_data, timezone_name)
 
-                # Downsample sgv events
-                df = df.loc[
-                    (df["eventType"] == "mbg")
-                    | ((df["eventType"] == "sgv") & (df.index % 10 == 0))
-                ]
+                # Downsample sgv events, keeping the highs and lows; mbg events are few, so keep them all
+                sgv_positions = np.flatnonzero(df["eventType"] == "sgv")
+                sgv = df.iloc[sgv_positions]
+                keep = np.union1d(
+                    np.flatnonzero(df["eventType"] == "mbg"),
+                    sgv_positions[downsample_min_max(sgv["datetime"], sgv["bg"])],
+                )
+                df = df.iloc[keep]
 
                 cgm_vs_mbg = (df["eventType"] == "sgv") * 0 + (
                     df["eventType"] == "mbg"
                 ) * 1
 
                 figure = go.Figure(
-                    data=go.Scatter(
+                    data=scatter_trace_type(len(df))(
                         x=df["datetime"],
                         y=df["bg"],
                         mode="markers",
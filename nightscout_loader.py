@@ -1,9 +1,38 @@
+import collections
+import itertools
+import json
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import pandas as pd
 import datetime
-from urllib.parse import urljoin
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse, urlsplit
+
+from nightscout_cache import NightscoutCache
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_nightscout_url(nightscout_url: str) -> str:
+    """
+    Reduce a Nightscout URL to its root, e.g. "example.com/api/v1/" -> "https://example.com", so that trivially
+    different ways of writing the same site are treated the same.
+    """
+    # Ensure that the URL starts with http:// or https://
+    parsed_url = urlsplit(nightscout_url)
+    if not parsed_url.scheme:
+        nightscout_url = "https://" + nightscout_url
+
+    # Extract the root URL and remove any trailing slash
+    parsed_url = urlparse(nightscout_url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}".rstrip("/")
 
 
 def get_entries_endpoint(nightscout_url):
@@ -18,137 +47,295 @@ def get_profile_endpoint(nightscout_url):
     return urljoin(nightscout_url, "api/v1/profile.json")
 
 
+TIME_STR_BY_MINUTE = [
+    f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(24 * 60)
+]
+WEEKDAY_NAMES = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+# Column types for data returned by fetch_nightscout_data, beyond the tz-aware datetime column (which pandas already
+# stores as int64 nanoseconds since the epoch) and the naive datetime64 date column. Most rows are CGM readings, so
+# treatment-only text columns are mostly empty; as categoricals they cost one small integer code per row instead of
+# one pointer per row plus a Python object per value. Temp basal rates (absolute) and durations stay float64 so they
+# compare exactly against scheduled rates.
+CATEGORICAL_COLS = ["eventType", "enteredBy", "reason", "notes", "weekday", "time_str"]
+FLOAT32_COLS = ["bg", "carbs", "insulin"]
+
+
 def add_time_identifiers(df: pd.DataFrame, datetime_col_name: str) -> None:
-    df["date"] = df[datetime_col_name].apply(
-        lambda dt: None if dt is None else dt.date()
-    )
-    df["weekday"] = df[datetime_col_name].apply(
-        lambda dt: None if dt is None else dt.strftime("%A")
-    )
-    df["weekday_number"] = df[datetime_col_name].apply(
-        lambda dt: None if dt is None else dt.weekday()
-    )
-    df["time"] = df[datetime_col_name].apply(
-        lambda dt: None if dt is None else dt.time()
-    )
-    df["time_str"] = df[datetime_col_name].apply(
-        lambda dt: None if dt is None else dt.time().strftime("%H:%M")
+    """
+    Add columns date, weekday, weekday_number, and time_str derived from a datetime column, in place. There is no
+    longer a time column, since it held one datetime.time object per row; use df[datetime_col_name].dt.time where
+    times of day are needed.
+
+    :param df: DataFrame to add columns to
+    :param datetime_col_name: name of a tz-aware datetime64 column in df, in the local timezone
+    """
+    datetimes = df[datetime_col_name].dt
+    # Local midnight as a naive datetime64, rather than one Python date object per row
+    df["date"] = datetimes.tz_localize(None).dt.normalize()
+    df["weekday"] = pd.Categorical(datetimes.day_name(), categories=WEEKDAY_NAMES)
+    df["weekday_number"] = datetimes.weekday.astype("int8")
+    # Look up "HH:MM" labels by minute of day rather than formatting each row individually
+    df["time_str"] = pd.Categorical.from_codes(
+        (datetimes.hour * 60 + datetimes.minute).to_numpy(),
+        categories=TIME_STR_BY_MINUTE,
     )
 
 
-def fetch_nightscout_data(
-    nightscout_url: str,
-    start_date: datetime.datetime = None,
-    end_date: datetime.datetime = None,
-    local_timezone_name: str = "UTC",
-) -> pd.DataFrame:
+def apply_compact_schema(all_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert data in the format returned by fetch_nightscout_data to the column types given by CATEGORICAL_COLS and
+    FLOAT32_COLS, in place. Columns that are already the right type are left alone, so this is cheap to re-apply
+    after combining frames (e.g. pd.concat falls back to object columns if categories differ).
 
-    date_strs = (
-        start_date.strftime("%Y-%m-%d") if start_date else None,
-        end_date.strftime("%Y-%m-%d") if end_date else None,
-    )
+    :return: all_data, for convenience
+    """
+    for col in CATEGORICAL_COLS:
+        if col in all_data and not isinstance(all_data[col].dtype, pd.CategoricalDtype):
+            all_data[col] = all_data[col].astype("category")
+    for col in FLOAT32_COLS:
+        if col in all_data and all_data[col].dtype != np.float32:
+            all_data[col] = pd.to_numeric(all_data[col]).astype(np.float32)
+    return all_data
 
-    bg_param_names = ("find[dateString][$gte]", "find[dateString][$lte]")
-    treatment_param_names = ("find[created_at][$gte]", "find[created_at][$lte]")
-    days_in_range = (end_date - start_date).days if None not in date_strs else 14
 
-    # Fetch blood glucose entries
-    bg_params = {
-        param: date
-        for param, date in zip(bg_param_names, date_strs)
-        if date is not None
-    }
-    bg_params["count"] = 12 * 24 * days_in_range
-    bg_list = requests.get(
-        get_entries_endpoint(nightscout_url),
-        params=bg_params,
-        headers={"accept": "application/json"},
-    ).json()
-    bg = pd.DataFrame.from_records(bg_list)
-    bg["datetime"] = pd.to_datetime(bg["date"], unit="ms", utc=True).dt.tz_convert(
-        local_timezone_name
-    )
-    # Limit columns
+def get_memory_per_day(all_data: pd.DataFrame) -> float:
+    """
+    :param all_data: data in the format returned by fetch_nightscout_data
+    :return: memory used by all_data (including the contents of object columns) per day of data, in bytes
+    """
+    n_days = max(all_data["date"].nunique(), 1)
+    return all_data.memory_usage(deep=True).sum() / n_days
+
+
+# Default number of days requested per window, and records requested per page, when walking a date range
+DEFAULT_WINDOW_DAYS = 7
+DEFAULT_PAGE_SIZE = 2000
+# Maximum number of concurrent requests (and pooled connections) per NightscoutClient, and per-request timeout
+DEFAULT_MAX_WORKERS = 6
+DEFAULT_TIMEOUT_SECONDS = 60
 
-    bg_cols = ["datetime", "sgv", "mbg", "type"]
+BG_COLS = ["datetime", "sgv", "mbg", "type"]
+TREATMENT_COLS = [
+    "datetime",
+    "carbs",
+    "insulin",
+    "eventType",
+    "enteredBy",
+    "notes",
+    "entered by",
+    "duration",
+    "absolute",
+    "reason",
+]
 
-    # TODO: factor out into helper
-    bg = bg[[col for col in bg_cols if col in bg]]
-    for col in bg_cols:
-        if col not in bg:
-            bg[col] = None
+
+def limit_columns(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """
+    Restrict a DataFrame to exactly the given columns, adding any that are missing as empty columns.
+
+    :param df: DataFrame built from Nightscout records
+    :param columns: names of columns to keep
+    :return: DataFrame with exactly these columns, in this order
+    """
+    return df.reindex(columns=columns)
+
+
+def entries_to_df(entries: List[dict], local_timezone_name: str) -> pd.DataFrame:
+    """
+    Convert a list of records from the Nightscout entries endpoint to a DataFrame.
+
+    :param entries: list of entry records as returned by the Nightscout API
+    :param local_timezone_name: Timezone name e.g. 'America/New_York'
+    :return: DataFrame with columns datetime, type, and bg (sgv or mbg value)
+    """
+    bg = pd.DataFrame.from_records(entries)
+    if "date" in bg:
+        bg["datetime"] = pd.to_datetime(bg["date"], unit="ms", utc=True).dt.tz_convert(
+            local_timezone_name
+        )
+    bg = limit_columns(bg, BG_COLS)
     # Combine bg values into a single column - we already have provenance in type column
     bg["bg"] = bg["sgv"].fillna(bg["mbg"])
-    bg.drop(columns=["sgv", "mbg"], inplace=True)
+    return bg.drop(columns=["sgv", "mbg"])
 
-    # Fetch treatment entries
-    treatment_params = {
-        param: date
-        for param, date in zip(treatment_param_names, date_strs)
-        if date is not None
-    }
-    treatment_params["count"] = 300 * days_in_range
-    treatments_list = requests.get(
-        get_treatments_endpoint(nightscout_url),
-        params=treatment_params,
-        headers={"accept": "application/json"},
-    ).json()
-    treatments = pd.DataFrame.from_records(treatments_list)
+
+def treatments_to_df(treatments: List[dict], local_timezone_name: str) -> pd.DataFrame:
+    """
+    Convert a list of records from the Nightscout treatments endpoint to a DataFrame.
+
+    :param treatments: list of treatment records as returned by the Nightscout API
+    :param local_timezone_name: Timezone name e.g. 'America/New_York'
+    :return: DataFrame with columns given by TREATMENT_COLS (with "entered by" merged into enteredBy)
+    """
+    treatments = pd.DataFrame.from_records(treatments)
     if "created_at" in treatments.columns:
-        treatments["datetime"] = pd.to_datetime(treatments["created_at"]).dt.tz_convert(
-            local_timezone_name
-        )
-    # Limit columns
-    treatment_cols = [
-        "datetime",
-        "carbs",
-        "insulin",
-        "eventType",
-        "enteredBy",
-        "notes",
-        "entered by",
-        "duration",
-        "absolute",
-        "reason",
-    ]
-    treatments = treatments[[col for col in treatment_cols if col in treatments]]
-    for col in treatment_cols:
-        if col not in treatments:
-            treatments[col] = None
+        treatments["datetime"] = pd.to_datetime(
+            treatments["created_at"], utc=True
+        ).dt.tz_convert(local_timezone_name)
+    treatments = limit_columns(treatments, TREATMENT_COLS)
     treatments["enteredBy"] = treatments["enteredBy"].fillna(treatments["entered by"])
-    treatments.drop(columns=["entered by"], inplace=True)
+    return treatments.drop(columns=["entered by"])
+
 
+def combine_entries_and_treatments(
+    bg: pd.DataFrame, treatments: pd.DataFrame, local_timezone_name: str
+) -> pd.DataFrame:
+    """
+    Combine entries and treatments (as returned by entries_to_df and treatments_to_df) into a single DataFrame
+    sorted by datetime, with time identifier columns added.
+    """
     all_data = pd.concat([bg, treatments])
+    # Make sure the datetime column keeps its dtype even if one of the frames was empty
+    all_data["datetime"] = pd.to_datetime(all_data["datetime"], utc=True).dt.tz_convert(
+        local_timezone_name
+    )
     all_data["eventType"] = all_data["type"].fillna(all_data["eventType"])
     all_data.drop(columns=["type"], inplace=True)
-    all_data.sort_values(by="datetime", inplace=True)
+    all_data.sort_values(by="datetime", inplace=True, kind="stable")
     all_data.reset_index(drop=True, inplace=True)
     add_time_identifiers(all_data, "datetime")
+    return apply_compact_schema(all_data)
 
-    return all_data
 
+def get_date_range(
+    start_date: datetime.date = None, end_date: datetime.date = None
+) -> Tuple[datetime.date, datetime.date]:
+    """
+    Fill in defaults for a [start_date, end_date) range of local dates and drop any time component.
+    """
+    end_date = (
+        pd.Timestamp(end_date).date()
+        if end_date is not None
+        else datetime.date.today() + datetime.timedelta(days=1)
+    )
+    start_date = (
+        pd.Timestamp(start_date).date()
+        if start_date is not None
+        else end_date - datetime.timedelta(days=14)
+    )
+    return start_date, end_date
 
-def fetch_profile_data(nightscout_url: str, local_timezone_name: str) -> pd.DataFrame:
+
+def get_window_bounds(
+    start_date: datetime.date,
+    end_date: datetime.date,
+    local_timezone_name: str,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
     """
-    Retrieves ALL profiles stored in Nightscout.
+    Split the local dates [start_date, end_date) into consecutive windows of at most window_days days.
 
-    :param nightscout_url: Base URL of Nightscout site
-    :param local_timezone_name: Timezone name e.g. 'America/New_York'
+    :return: list of (window_start, window_end) tz-aware timestamps at local midnight; each window is half-open.
+    """
+    day_starts = pd.date_range(start=start_date, end=end_date, freq="D").tz_localize(
+        local_timezone_name, ambiguous=True, nonexistent="shift_forward"
+    )
+    boundaries = list(day_starts[::window_days])
+    if boundaries[-1] != day_starts[-1]:
+        boundaries.append(day_starts[-1])
+    return list(zip(boundaries[:-1], boundaries[1:]))
 
-    :return: Pandas DataFrame with one row per basal rate, and columns:
-       * name (name of the profile, not necessarily unique)
-       * profile_id (unique ID of profile)
-       * profile_start_datetime (when profile took effect)
-       * basal_start_time_seconds (time in seconds since midnight when THIS basal rate for this profile takes effect)
-       * units_per_hour_scheduled (basal rate)
-       Rows are sorted by profile_start_datetime, then basal_start_time_seconds.
 
+def format_created_at(timestamp: pd.Timestamp) -> str:
+    """
+    Format a timestamp the way Nightscout stores treatment created_at values (ISO 8601 in UTC), so that string
+    comparisons in queries line up with stored values.
+    """
+    return timestamp.tz_convert("UTC").strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def empty_nightscout_data(local_timezone_name: str) -> pd.DataFrame:
+    """
+    :return: DataFrame with no rows, in the format returned by fetch_nightscout_data
+    """
+    return combine_entries_and_treatments(
+        entries_to_df([], local_timezone_name),
+        treatments_to_df([], local_timezone_name),
+        local_timezone_name,
+    )
+
+
+def concat_chunks(chunks: List[pd.DataFrame], local_timezone_name: str) -> pd.DataFrame:
+    """
+    Concatenate time-ordered chunks of data as returned by NightscoutClient.iter_data. Empty chunks are skipped so
+    that their placeholder column types don't override the real ones.
+    """
+    chunks = [chunk for chunk in chunks if len(chunk)]
+    if not chunks:
+        return empty_nightscout_data(local_timezone_name)
+    return apply_compact_schema(pd.concat(chunks, ignore_index=True))
+
+
+def merge_sorted(
+    all_data: pd.DataFrame, new_data: pd.DataFrame, local_timezone_name: str
+) -> pd.DataFrame:
+    """
+    Merge two DataFrames that are each sorted by datetime into one sorted DataFrame. A stable sort (timsort) finds
+    the two sorted runs and merges them in linear time, rather than sorting from scratch. Rows with equal datetimes
+    keep all_data's first.
+
+    :return: merged data, with a new RangeIndex
+    """
+    combined = concat_chunks([all_data, new_data], local_timezone_name)
+    return combined.sort_values(by="datetime", kind="stable", ignore_index=True)
+
+
+def replace_tail(
+    all_data: pd.DataFrame,
+    tail: pd.DataFrame,
+    since: pd.Timestamp,
+    local_timezone_name: str,
+) -> pd.DataFrame:
+    """
+    Merge newly-fetched recent data into existing data. tail must hold everything Nightscout has from since onwards
+    (see NightscoutClient.fetch_since), so existing rows at or after since are dropped rather than compared: rows
+    that were already loaded are replaced by their refetched copies, and nothing is duplicated.
+
+    :param all_data: existing data, sorted by datetime
+    :param tail: data with datetime >= since, sorted by datetime
+    :return: combined data, sorted by datetime
+    """
+    n_kept = all_data["datetime"].searchsorted(since, side="left")
+    return concat_chunks([all_data.iloc[:n_kept], tail], local_timezone_name)
+
+
+def split_by_day(
+    all_data: pd.DataFrame,
+    window_start: pd.Timestamp,
+    window_end: pd.Timestamp,
+    local_timezone_name: str,
+) -> Dict[datetime.date, pd.DataFrame]:
+    """
+    Split data (sorted by datetime) covering [window_start, window_end) into one DataFrame per local date. Dates
+    with no data get an empty DataFrame.
+    """
+    day_starts = pd.date_range(
+        window_start.date(), window_end.date(), freq="D"
+    ).tz_localize(local_timezone_name, ambiguous=True, nonexistent="shift_forward")
+    boundaries = all_data["datetime"].searchsorted(day_starts)
+    return {
+        day_start.date(): all_data.iloc[i_start:i_end].reset_index(drop=True)
+        for day_start, i_start, i_end in zip(
+            day_starts[:-1], boundaries[:-1], boundaries[1:]
+        )
+    }
+
+
+def profiles_to_df(profile_list: List[dict], local_timezone_name: str) -> pd.DataFrame:
+    """
+    Convert the list of profiles returned by the Nightscout profile endpoint to one row per basal rate.
+
+    See fetch_profile_data for the format of the returned DataFrame.
     """
-    profile_list = requests.get(
-        get_profile_endpoint(nightscout_url),
-        params={},
-        headers={"accept": "application/json"},
-    ).json()
     basal_list = [
         profile | basal_rates
         for profile in profile_list
@@ -174,11 +361,662 @@ def fetch_profile_data(nightscout_url: str, local_timezone_name: str) -> pd.Data
     return basals.sort_values(by=["profile_start_datetime", "basal_start_time_seconds"])
 
 
+def get_record_key(record: dict):
+    """
+    :return: key identifying a Nightscout record, for de-duplicating records fetched more than once: its _id, or its
+        whole content if it has none
+    """
+    if "_id" in record:
+        return "_id", record["_id"]
+    return "content", json.dumps(record, sort_keys=True, default=str)
+
+
+class NightscoutClient:
+    """
+    Fetches data from a single Nightscout site. All requests share one keep-alive connection pool, and independent
+    requests (entries, treatments, profiles, and separate time windows) are issued concurrently on a bounded thread
+    pool. If a NightscoutCache is given, days already stored there are not requested at all.
+
+    Use as a context manager so the connections and threads are released when done:
+
+        with NightscoutClient(nightscout_url) as client:
+            all_data, profiles = client.fetch_data_and_profiles(start_date, end_date, "America/New_York")
+    """
+
+    def __init__(
+        self,
+        nightscout_url: str,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        timeout: float = DEFAULT_TIMEOUT_SECONDS,
+        cache: Optional[NightscoutCache] = None,
+    ):
+        """
+        :param nightscout_url: Base URL of Nightscout site
+        :param cache: on-disk cache to consult before requesting entries and treatments, and to store results in
+        :param max_workers: maximum number of requests in flight at once (also the connection pool size)
+        :param timeout: timeout in seconds for each individual request
+        """
+        self.nightscout_url = normalize_nightscout_url(nightscout_url)
+        self.cache = cache
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"accept": "application/json"})
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        # Don't wait on requests nobody will read (e.g. if iteration stopped early because of an error)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
+
+    def get_json(self, endpoint: str, params: dict):
+        """
+        GET an endpoint and decode the JSON response.
+
+        :raises requests.exceptions.RequestException: if the request fails or the response is not valid JSON
+        """
+        response = self.session.get(endpoint, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_paged_records(
+        self,
+        endpoint: str,
+        cursor_field: str,
+        lower_bound,
+        upper_bound,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> List[dict]:
+        """
+        Fetch ALL records from a Nightscout collection with lower_bound <= cursor_field < upper_bound, walking
+        backwards in time one page at a time. Nightscout returns the newest records first, so after each full page we
+        move the upper bound to the oldest record seen. We only stop once a page comes back short, rather than
+        trusting a guessed count to cover the whole range.
+
+        The one case this can't handle is more than page_size records sharing a single timestamp: only the first
+        page_size of them can be requested, so the rest are skipped and a warning is logged.
+
+        :param endpoint: URL of the entries or treatments endpoint
+        :param cursor_field: field to page on ("date" for entries, "created_at" for treatments)
+        :param lower_bound: inclusive lower bound, in the same representation Nightscout stores for cursor_field
+        :param upper_bound: exclusive upper bound, same representation as lower_bound
+        :param page_size: number of records requested per page
+        :return: list of records, newest first, de-duplicated by _id (or, for records without one, by content)
+        """
+        records = []
+        seen_keys = set()
+        upper_op = "$lt"
+        while True:
+            page = self.get_json(
+                endpoint,
+                params={
+                    f"find[{cursor_field}][$gte]": lower_bound,
+                    f"find[{cursor_field}][{upper_op}]": upper_bound,
+                    "count": page_size,
+                },
+            )
+            new_records = []
+            for record in page:
+                key = get_record_key(record)
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    new_records.append(record)
+            records += new_records
+            if len(page) < page_size:
+                return records
+            upper_bound = min(record[cursor_field] for record in page)
+            # Records sharing the oldest timestamp may straddle the page boundary, so re-request that timestamp
+            # (duplicates are dropped). If that brought nothing new, the whole page shares one timestamp and there may
+            # be more records at it than we can request, so step past it instead.
+            if new_records:
+                upper_op = "$lte"
+            else:
+                logger.warning(
+                    "More than %d records in %s have %s=%s; only the first %d were fetched",
+                    page_size,
+                    endpoint,
+                    cursor_field,
+                    upper_bound,
+                    page_size,
+                )
+                upper_op = "$lt"
+
+    def fetch_entries(
+        self,
+        window_start: pd.Timestamp,
+        window_end: pd.Timestamp,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> List[dict]:
+        """
+        :return: all entry records with window_start <= date < window_end
+        """
+        return self.fetch_paged_records(
+            get_entries_endpoint(self.nightscout_url),
+            "date",
+            int(window_start.timestamp() * 1000),
+            int(window_end.timestamp() * 1000),
+            page_size=page_size,
+        )
+
+    def fetch_treatments(
+        self,
+        window_start: pd.Timestamp,
+        window_end: pd.Timestamp,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> List[dict]:
+        """
+        :return: all treatment records with window_start <= created_at < window_end
+        """
+        return self.fetch_paged_records(
+            get_treatments_endpoint(self.nightscout_url),
+            "created_at",
+            format_created_at(window_start),
+            format_created_at(window_end),
+            page_size=page_size,
+        )
+
+    def iter_data(
+        self,
+        start_date: datetime.date = None,
+        end_date: datetime.date = None,
+        local_timezone_name: str = "UTC",
+        window_days: int = DEFAULT_WINDOW_DAYS,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Fetch entries and treatments one time window at a time, yielding a DataFrame per window. Windows are
+        requested concurrently, but only up to max_workers windows ahead of the one being yielded so that memory
+        use stays bounded for long ranges.
+
+        :param start_date: first local date to fetch (defaults to 14 days before end_date)
+        :param end_date: local date to stop at, exclusive (defaults to tomorrow, i.e. include today)
+        :param local_timezone_name: Timezone name e.g. 'America/New_York'
+        :param window_days: number of days to request per window
+        :param page_size: number of records to request per page within a window
+        :param progress_callback: called as progress_callback(n_days_done, n_days_total) as each window is ready
+        :return: iterator over DataFrames in the format returned by fetch_nightscout_data, in time order
+        """
+        start_date, end_date = get_date_range(start_date, end_date)
+        return self.iter_dates(
+            [
+                start_date + datetime.timedelta(days=i)
+                for i in range((end_date - start_date).days)
+            ],
+            local_timezone_name,
+            window_days=window_days,
+            page_size=page_size,
+            progress_callback=progress_callback,
+        )
+
+    def iter_dates(
+        self,
+        dates: Iterable[datetime.date],
+        local_timezone_name: str = "UTC",
+        window_days: int = DEFAULT_WINDOW_DAYS,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Like iter_data, but for any set of local dates, which need not be contiguous (e.g. the gaps between ranges
+        that are already loaded). Windows never span a gap, and all windows share the same bounded pipeline of
+        concurrent requests, so filling several gaps takes about as long as filling one of the same total size.
+
+        :param dates: local dates to fetch
+        See iter_data for the remaining parameters.
+        :return: iterator over DataFrames in the format returned by fetch_nightscout_data, in time order
+        """
+        days = sorted(set(dates))
+        cached_days = (
+            self.cache.get_partitions(self.nightscout_url, local_timezone_name, days)
+            if self.cache
+            else {}
+        )
+        # Walk runs of consecutive days that are all cached or all uncached, splitting each into windows.
+        # Consecutive days have the same (ordinal - position), so that identifies the contiguous stretch.
+        windows = iter(
+            [
+                (window_start, window_end, is_cached)
+                for (_, is_cached), run in itertools.groupby(
+                    enumerate(days),
+                    key=lambda item: (
+                        item[1].toordinal() - item[0],
+                        item[1] in cached_days,
+                    ),
+                )
+                for run_days in [[day for _, day in run]]
+                for (window_start, window_end) in get_window_bounds(
+                    run_days[0],
+                    run_days[-1] + datetime.timedelta(days=1),
+                    local_timezone_name,
+                    window_days,
+                )
+            ]
+        )
+        pending = collections.deque()
+        n_days_done = 0
+
+        def report_progress(window_start: pd.Timestamp, window_end: pd.Timestamp):
+            nonlocal n_days_done
+            n_days_done += (window_end.date() - window_start.date()).days
+            if progress_callback:
+                progress_callback(n_days_done, len(days))
+
+        def submit_next(n_windows: int) -> None:
+            for window_start, window_end, is_cached in itertools.islice(
+                windows, n_windows
+            ):
+                pending.append(
+                    (
+                        window_start,
+                        window_end,
+                        time.time(),
+                        None
+                        if is_cached
+                        else self.submit_window(window_start, window_end, page_size),
+                    )
+                )
+
+        submit_next(self.max_workers)
+        while pending:
+            window_start, window_end, fetched_at, futures = pending.popleft()
+            submit_next(1)
+            if futures is None:
+                report_progress(window_start, window_end)
+                yield concat_chunks(
+                    [
+                        cached_days[window_start.date() + datetime.timedelta(days=i)]
+                        for i in range((window_end.date() - window_start.date()).days)
+                    ],
+                    local_timezone_name,
+                )
+                continue
+            entries_future, treatments_future = futures
+            chunk = combine_entries_and_treatments(
+                entries_to_df(entries_future.result(), local_timezone_name),
+                treatments_to_df(treatments_future.result(), local_timezone_name),
+                local_timezone_name,
+            )
+            if self.cache:
+                self.cache.put_partitions(
+                    self.nightscout_url,
+                    local_timezone_name,
+                    split_by_day(chunk, window_start, window_end, local_timezone_name),
+                    fetched_at,
+                )
+            report_progress(window_start, window_end)
+            yield chunk
+
+    def submit_window(
+        self, window_start: pd.Timestamp, window_end: pd.Timestamp, page_size: int
+    ) -> Tuple[Future, Future]:
+        """
+        Start fetching the entries and treatments for one window.
+
+        :return: futures for the entry records and the treatment records
+        """
+        return (
+            self.executor.submit(
+                self.fetch_entries, window_start, window_end, page_size
+            ),
+            self.executor.submit(
+                self.fetch_treatments, window_start, window_end, page_size
+            ),
+        )
+
+    def fetch_data(
+        self,
+        start_date: datetime.date = None,
+        end_date: datetime.date = None,
+        local_timezone_name: str = "UTC",
+        window_days: int = DEFAULT_WINDOW_DAYS,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> pd.DataFrame:
+        """
+        Fetch all entries and treatments for the local dates [start_date, end_date).
+
+        See iter_data for parameters; this just concatenates the chunks it yields.
+
+        :return: DataFrame with one row per entry or treatment, sorted by datetime
+        """
+        chunks = list(
+            self.iter_data(
+                start_date,
+                end_date,
+                local_timezone_name,
+                window_days=window_days,
+                page_size=page_size,
+                progress_callback=progress_callback,
+            )
+        )
+        return concat_chunks(chunks, local_timezone_name)
+
+    def fetch_dates(
+        self,
+        dates: Iterable[datetime.date],
+        local_timezone_name: str = "UTC",
+        window_days: int = DEFAULT_WINDOW_DAYS,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> pd.DataFrame:
+        """
+        Fetch all entries and treatments for a set of (not necessarily contiguous) local dates.
+
+        See iter_dates for parameters; this just concatenates the chunks it yields.
+
+        :return: DataFrame with one row per entry or treatment, sorted by datetime
+        """
+        chunks = list(
+            self.iter_dates(
+                dates,
+                local_timezone_name,
+                window_days=window_days,
+                page_size=page_size,
+                progress_callback=progress_callback,
+            )
+        )
+        return concat_chunks(chunks, local_timezone_name)
+
+    def fetch_since(
+        self,
+        since: pd.Timestamp,
+        local_timezone_name: str = "UTC",
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> pd.DataFrame:
+        """
+        Fetch all entries and treatments from since onwards, e.g. to bring already-loaded data up to date without
+        refetching whole days. Merge the result with replace_tail. The local data cache is not updated, since the
+        current day is never complete.
+
+        :param since: tz-aware datetime of the earliest data to fetch
+        :return: DataFrame in the format returned by fetch_nightscout_data
+        """
+        # Leave room for uploaders whose clocks run ahead of ours
+        until = pd.Timestamp.now(tz="UTC") + pd.Timedelta(days=1)
+        entries_future, treatments_future = self.submit_window(since, until, page_size)
+        return combine_entries_and_treatments(
+            entries_to_df(entries_future.result(), local_timezone_name),
+            treatments_to_df(treatments_future.result(), local_timezone_name),
+            local_timezone_name,
+        )
+
+    def fetch_profiles(self, local_timezone_name: str) -> pd.DataFrame:
+        """
+        Retrieves ALL profiles stored in Nightscout. See fetch_profile_data for the format of the result.
+        """
+        return profiles_to_df(
+            self.get_json(get_profile_endpoint(self.nightscout_url), params={}),
+            local_timezone_name,
+        )
+
+    def fetch_data_and_profiles(
+        self,
+        start_date: datetime.date = None,
+        end_date: datetime.date = None,
+        local_timezone_name: str = "UTC",
+        **kwargs,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Fetch entries, treatments, and profiles at the same time.
+
+        :param kwargs: passed on to fetch_data
+        :return: tuple of (data as returned by fetch_data, profiles as returned by fetch_profiles)
+        """
+        profiles_future = self.executor.submit(self.fetch_profiles, local_timezone_name)
+        all_data = self.fetch_data(start_date, end_date, local_timezone_name, **kwargs)
+        return all_data, profiles_future.result()
+
+
+def iter_nightscout_data(
+    nightscout_url: str,
+    start_date: datetime.date = None,
+    end_date: datetime.date = None,
+    local_timezone_name: str = "UTC",
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cache: Optional[NightscoutCache] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Fetch entries and treatments from Nightscout one time window at a time, yielding a DataFrame per window.
+
+    :param nightscout_url: Base URL of Nightscout site
+    :param cache: optional on-disk cache, see NightscoutClient
+    See NightscoutClient.iter_data for the remaining parameters.
+    """
+    with NightscoutClient(nightscout_url, cache=cache) as client:
+        yield from client.iter_data(
+            start_date,
+            end_date,
+            local_timezone_name,
+            window_days=window_days,
+            page_size=page_size,
+        )
+
+
+def fetch_nightscout_data(
+    nightscout_url: str,
+    start_date: datetime.date = None,
+    end_date: datetime.date = None,
+    local_timezone_name: str = "UTC",
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cache: Optional[NightscoutCache] = None,
+) -> pd.DataFrame:
+    """
+    Fetch all entries and treatments from Nightscout for the local dates [start_date, end_date).
+
+    :param nightscout_url: Base URL of Nightscout site
+    :param cache: optional on-disk cache, see NightscoutClient
+    See NightscoutClient.iter_data for the remaining parameters.
+
+    :return: DataFrame with one row per entry or treatment, sorted by datetime
+    """
+    with NightscoutClient(nightscout_url, cache=cache) as client:
+        return client.fetch_data(
+            start_date,
+            end_date,
+            local_timezone_name,
+            window_days=window_days,
+            page_size=page_size,
+        )
+
+
+def fetch_profile_data(nightscout_url: str, local_timezone_name: str) -> pd.DataFrame:
+    """
+    Retrieves ALL profiles stored in Nightscout.
+
+    :param nightscout_url: Base URL of Nightscout site
+    :param local_timezone_name: Timezone name e.g. 'America/New_York'
+
+    :return: Pandas DataFrame with one row per basal rate, and columns:
+       * name (name of the profile, not necessarily unique)
+       * profile_id (unique ID of profile)
+       * profile_start_datetime (when profile took effect)
+       * basal_start_time_seconds (time in seconds since midnight when THIS basal rate for this profile takes effect)
+       * units_per_hour_scheduled (basal rate)
+       Rows are sorted by profile_start_datetime, then basal_start_time_seconds.
+
+    """
+    with NightscoutClient(nightscout_url) as client:
+        return client.fetch_profiles(local_timezone_name)
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def to_epoch_ns(datetimes) -> np.ndarray:
+    """
+    :param datetimes: tz-aware datetimes (anything accepted by pd.DatetimeIndex)
+    :return: int64 numpy array of nanoseconds since the Unix epoch
+    """
+    utc = pd.DatetimeIndex(datetimes).tz_convert("UTC").tz_localize(None)
+    return np.asarray(utc, dtype="datetime64[ns]").view("int64")
+
+
+def get_seconds_of_day(datetimes) -> np.ndarray:
+    """
+    :param datetimes: datetimes (anything accepted by pd.DatetimeIndex), already in the timezone of interest
+    :return: numpy array of the (wall clock) time of day of each datetime, in whole seconds since midnight
+    """
+    datetimes = pd.DatetimeIndex(datetimes)
+    return np.asarray(
+        datetimes.hour * 3600 + datetimes.minute * 60 + datetimes.second,
+        dtype="int64",
+    )
+
+
+class BasalSchedule:
+    """
+    Compiled index of the scheduled basal rates from all profiles, for looking up the scheduled rate at many
+    timestamps at once.
+
+    Each basal rate row is keyed by (profile epoch, seconds since midnight), where profile epochs are numbered in order
+    of profile_start_datetime. Flattening that key to epoch * SECONDS_PER_DAY + seconds gives one sorted array, so the
+    rate in effect at any timestamp is found with two binary searches: one for the epoch, one for the rate within it.
+    """
+
+    def __init__(self, profiles: pd.DataFrame):
+        """
+        :param profiles: Pandas dataframe as returned by fetch_profile_data, with at least columns
+            profile_start_datetime, basal_start_time_seconds, and units_per_hour_scheduled
+        """
+        profiles = profiles.sort_values(
+            by=["profile_start_datetime", "basal_start_time_seconds"], kind="stable"
+        )
+        self.timezone = profiles["profile_start_datetime"].dt.tz
+        row_start_ns = to_epoch_ns(profiles["profile_start_datetime"])
+        self.epoch_start_ns = np.unique(row_start_ns)
+        row_epochs = np.searchsorted(self.epoch_start_ns, row_start_ns)
+        self.keys = row_epochs * SECONDS_PER_DAY + profiles[
+            "basal_start_time_seconds"
+        ].to_numpy(dtype="int64")
+        self.rates = profiles["units_per_hour_scheduled"].to_numpy(dtype=float)
+
+    def lookup(self, timestamps) -> np.ndarray:
+        """
+        Find the scheduled basal rate at each of a batch of timestamps, based on (a) the last profile to take effect
+        at or before the timestamp and (b) the last basal rate in that profile starting at or before the timestamp's
+        local time of day.
+
+        :param timestamps: tz-aware timestamps (anything accepted by pd.DatetimeIndex)
+        :return: numpy array of scheduled basal rates in u/hr, NaN where no profile was in effect yet
+        """
+        timestamps = pd.DatetimeIndex(timestamps).tz_convert(self.timezone)
+        epochs = (
+            np.searchsorted(self.epoch_start_ns, to_epoch_ns(timestamps), side="right")
+            - 1
+        )
+        key_indices = (
+            np.searchsorted(
+                self.keys,
+                epochs * SECONDS_PER_DAY + get_seconds_of_day(timestamps),
+                side="right",
+            )
+            - 1
+        )
+        rates = self.rates[np.maximum(key_indices, 0)]
+        rates[(epochs < 0) | (key_indices < 0)] = np.nan
+        return rates
+
+    def get_change_times(
+        self, start_date: datetime.date, end_date: datetime.date
+    ) -> pd.DataFrame:
+        """
+        Find every time the scheduled basal rate changes on the local dates start_date through end_date, i.e. each
+        profile's basal rates repeated on every day that profile was in effect, plus the moments profiles took effect.
+
+        E.g. expands "1u from 0-3 and 2u from 3-24, starting 9/1/2022" to "1u from 0-3 9/1/2022, 2u from 3-24 9/1/2022,
+        1u from 0-3 9/2/2022, ...". The expansion is done in one vectorized pass over (profile epoch, day, rate) triples,
+        only for the days each epoch actually overlaps the requested range. On days when clocks change, a rate
+        starting at a nonexistent local time takes effect when the clocks skip ahead, and a rate starting at an
+        ambiguous local time takes effect at its first occurrence.
+
+        :return: DataFrame with columns datetime (tz-aware) and units_per_hour_scheduled, sorted by datetime
+        """
+        epoch_starts = pd.DatetimeIndex(self.epoch_start_ns.astype("datetime64[ns]"))
+        epoch_starts = epoch_starts.tz_localize("UTC").tz_convert(self.timezone)
+        epoch_start_days = epoch_starts.tz_localize(None).normalize().to_numpy()
+        range_start = np.datetime64(start_date, "ns")
+        range_end = np.datetime64(end_date, "ns")
+
+        # One row per (epoch, day): each epoch runs from the day it starts to the day the next one starts
+        first_days = np.maximum(epoch_start_days, range_start)
+        last_days = np.append(np.minimum(epoch_start_days[1:], range_end), range_end)
+        n_days = np.maximum((last_days - first_days) // np.timedelta64(1, "D") + 1, 0)
+        day_epochs = np.repeat(np.arange(len(epoch_starts)), n_days)
+        day_offsets = np.arange(len(day_epochs)) - np.repeat(
+            np.cumsum(n_days) - n_days, n_days
+        )
+        days = first_days[day_epochs] + day_offsets * np.timedelta64(1, "D")
+
+        # One row per (epoch, day, rate)
+        epoch_key_starts = np.searchsorted(
+            self.keys, np.arange(len(epoch_starts) + 1) * SECONDS_PER_DAY
+        )
+        n_rates = np.diff(epoch_key_starts)[day_epochs]
+        row_epochs = np.repeat(day_epochs, n_rates)
+        row_keys = np.arange(len(row_epochs)) - np.repeat(
+            np.cumsum(n_rates) - n_rates, n_rates
+        )
+        row_keys += epoch_key_starts[row_epochs]
+        local_times = np.repeat(days, n_rates) + (
+            self.keys[row_keys] - row_epochs * SECONDS_PER_DAY
+        ) * np.timedelta64(1, "s")
+        change_times = pd.DatetimeIndex(local_times).tz_localize(
+            self.timezone,
+            ambiguous=np.ones(len(local_times), dtype=bool),
+            nonexistent="shift_forward",
+        )
+
+        # Drop rates from before the epoch actually took effect & after the next one did
+        row_times_ns = to_epoch_ns(change_times)
+        next_epoch_start_ns = np.append(self.epoch_start_ns[1:], np.iinfo("int64").max)
+        in_effect = (row_times_ns >= self.epoch_start_ns[row_epochs]) & (
+            row_times_ns < next_epoch_start_ns[row_epochs]
+        )
+
+        # Also include a row any time the profile itself changed during the interval
+        epoch_in_range = (epoch_start_days >= range_start) & (
+            epoch_start_days <= range_end
+        )
+        return pd.DataFrame(
+            {
+                "datetime": change_times[in_effect].append(
+                    epoch_starts[epoch_in_range]
+                ),
+                "units_per_hour_scheduled": np.concatenate(
+                    [
+                        self.rates[row_keys[in_effect]],
+                        self.lookup(epoch_starts[epoch_in_range]),
+                    ]
+                ),
+            }
+        ).sort_values(by="datetime", kind="stable", ignore_index=True)
+
+
 def get_scheduled_basal(profiles: pd.DataFrame, timestamp: pd.Timestamp) -> float:
     """
     Given a dataframe of scheduled basal rates from multiple profiles, find the rate that was active at a given time
     based on (a) when each profile took effect and (b) when the scheduled basal rates change.
 
+    To look up many timestamps, build a BasalSchedule once and use its lookup method instead.
+
     :param profiles: Pandas dataframe as returned by fetch_profile_date, with at least columns profile_start_datetime
         and basal_start_time_seconds
     :param timestamp: Timestamp or other type that can be converted by pd.to_datetime. This will be compared directly
@@ -186,19 +1024,48 @@ def get_scheduled_basal(profiles: pd.DataFrame, timestamp: pd.Timestamp) -> floa
 
     :return: Basal rate scheduled at timestamp according to profiles, in u/hr
     """
+    return BasalSchedule(profiles).lookup([pd.to_datetime(timestamp)])[0]
+
+
+BASAL_BIN_SIZE = datetime.timedelta(hours=1)
+
 
-    # We want the last *profile* before this timestamp, and
-    # from that one, we want the last *time interval* before this timestamp
-    # We assume the profiles are sorted by effective date, then time in seconds.
-    timestamp = pd.to_datetime(timestamp)
-    applicable_profile_rows = profiles.loc[
-        (profiles["profile_start_datetime"] <= timestamp)
-        & (
-            profiles["basal_start_time_seconds"]
-            <= timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+def get_bin_averages(
+    change_times_ns: np.ndarray, values: np.ndarray, bin_edges_ns: np.ndarray
+) -> np.ndarray:
+    """
+    Average a piecewise-constant function over consecutive bins, exactly, using only its change points.
+
+    The integral up to any time t is the integral up to the last change point at or before t plus the value there
+    times the remaining time, so integrals at all bin edges come from one cumulative sum and one binary search.
+
+    :param change_times_ns: sorted, unique times (ns since epoch) at which the function takes a new value
+    :param values: value taking effect at each change time (NaN for unknown)
+    :param bin_edges_ns: sorted bin edges (ns since epoch); bin i is [bin_edges_ns[i], bin_edges_ns[i + 1])
+    :return: time-weighted mean value over each bin; NaN if the value is unknown anywhere in the bin (including
+        before the first change time)
+    """
+
+    def integrate_to_edges(step_values: np.ndarray) -> np.ndarray:
+        integral_at_changes = np.concatenate(
+            [[0.0], np.cumsum(step_values[:-1] * np.diff(change_times_ns))]
+        )
+        i_change = np.searchsorted(change_times_ns, bin_edges_ns, side="right") - 1
+        i_valid = np.maximum(i_change, 0)
+        return integral_at_changes[i_valid] + step_values[i_valid] * (
+            bin_edges_ns - change_times_ns[i_valid]
         )
-    ]
-    return applicable_profile_rows.iloc[-1]["units_per_hour_scheduled"]
+
+    if len(change_times_ns) == 0:
+        return np.full(len(bin_edges_ns) - 1, np.nan)
+    is_unknown = np.isnan(values)
+    averages = np.diff(integrate_to_edges(np.where(is_unknown, 0.0, values))) / np.diff(
+        bin_edges_ns
+    )
+    unknown_time = np.diff(integrate_to_edges(is_unknown.astype(float)))
+    starts_before_data = bin_edges_ns[:-1] < change_times_ns[0]
+    averages[(unknown_time > 0) | starts_before_data] = np.nan
+    return averages
 
 
 def get_basal_per_hour(
@@ -217,9 +1084,16 @@ def get_basal_per_hour(
         * reason (reason for temp basal)
     :param profiles: Pandas dataframe as returned by fetch_profile_date, with at least columns profile_start_datetime,
         profile_id, and basal_start_time_seconds
-    :return:
+    :return: DataFrame with one row per hour from start_date through end_date, indexed by the last minute of each
+        hour, with columns:
+        * avg_basal (insulin actually delivered during the hour, including automatic boluses, in u/hr)
+        * scheduled (time-weighted mean of the regularly-scheduled rate during the hour, in u/hr)
+        * is_adjusted (whether delivery differed from the schedule at any point during the hour)
+        * time_label (time of day of the row, on start_date)
+        * date
     """
 
+    schedule = BasalSchedule(profiles)
     start_datetime = pd.to_datetime(start_date, utc=False).tz_localize(timezone_name)
     end_datetime = pd.to_datetime(
         end_date + datetime.timedelta(days=1), utc=False
@@ -256,94 +1130,19 @@ def get_basal_per_hour(
     regularly_scheduled_at_expiration = pd.DataFrame(
         data={
             "datetime": temp_basal_expirations,
-            "absolute": [
-                get_scheduled_basal(profiles, dts) for dts in temp_basal_expirations
-            ],
+            "absolute": schedule.lookup(temp_basal_expirations),
         }
     )
 
-    # Find all the times when the regularly-scheduled basal profile would *change* during this interval
-
-    # For each profile, get the datetime where the *next* profile will take effect (to aid in removing entries that
-    # are superceded by that next profile!
-    profiles["profile_number"] = profiles.groupby("profile_id").ngroup()
-    profiles["next_profile_number"] = profiles["profile_number"] + 1
-    profile_start_times = profiles[
-        ["profile_number", "profile_start_datetime"]
-    ].drop_duplicates()
-    profiles = pd.merge(
-        left=profiles,
-        right=profile_start_times,
-        how="left",
-        left_on="next_profile_number",
-        right_on="profile_number",
-        suffixes=[None, "_next"],
-    )
-
-    # Make a dataframe that has start datetimes of each basal rate, rather than start datetime for the profile plus
-    # start *time*s of each rate. E.g. expand "1u from 0-3 and 2u from 3-24, starting 9/1/2022" to "1u from 0-3
-    # 9/1/2022, 2u from 3-24 9/1/2022, 1u from 0-3 9/2/2022, ..."
-    profile_repeats = []
-    for profile_num in profiles["profile_number"].unique():
-        this_profile = profiles.loc[profiles["profile_number"] == profile_num]
-        range_start = this_profile.iloc[0]["profile_start_datetime"].date()
-        range_end = (
-            end_date
-            if pd.isna(this_profile.iloc[0]["profile_number_next"])
-            else this_profile.iloc[0]["profile_start_datetime_next"].date()
-        )
-        date_range = pd.date_range(
-            start=max([range_start, start_date]),
-            end=range_end,
-        )
-        profile_repeats.append(
-            pd.merge(
-                left=this_profile,
-                right=pd.DataFrame(data={"date": date_range}),
-                how="cross",
-            )
-        )
-    basal_change_times = pd.concat(profile_repeats)
-    basal_change_times["datetime"] = (
-        basal_change_times["date"]
-        + pd.to_timedelta(basal_change_times["basal_start_time_seconds"], unit="s")
-    ).dt.tz_localize(tz=timezone_name, ambiguous="NaT", nonexistent="shift_forward")
-
-    # Filter out rows from before the current profile actually took effect & after the next one did
-    basal_change_times = basal_change_times.loc[
-        (basal_change_times["datetime"] >= basal_change_times["profile_start_datetime"])
-        & (
-            (
-                basal_change_times["datetime"]
-                < basal_change_times["profile_start_datetime_next"]
-            )
-            | pd.isnull(basal_change_times["profile_start_datetime_next"])
-        )
-        & (basal_change_times["datetime"].dt.date <= end_date)
-    ]
-
-    # Also throw in a row any time the profile itself changed during the interval, and a row
-    # at the end of the interval to make sure we sample all the way to the end
-    profile_change_times = pd.Series(profiles["profile_start_datetime"].unique())
-    profile_change_times = profile_change_times.loc[
-        (profile_change_times.dt.date >= start_date)
-        & (profile_change_times.dt.date <= end_date)
-    ]
-    profile_change_times = pd.concat(
-        [
-            profile_change_times,
-            pd.Series([end_datetime]),
-        ]
-    )
+    # Find all the times when the regularly-scheduled basal rate would *change* during this interval, plus a row at
+    # the end of the interval to make sure we sample all the way to the end
     basal_change_times = pd.concat(
         [
-            basal_change_times[["datetime", "units_per_hour_scheduled"]],
+            schedule.get_change_times(start_date, end_date),
             pd.DataFrame(
                 {
-                    "datetime": profile_change_times,
-                    "units_per_hour_scheduled": profile_change_times.apply(
-                        lambda x: get_scheduled_basal(profiles, x)
-                    ),
+                    "datetime": [end_datetime],
+                    "units_per_hour_scheduled": schedule.lookup([end_datetime]),
                 }
             ),
         ]
@@ -371,69 +1170,97 @@ def get_basal_per_hour(
             regularly_scheduled_at_expiration,
         ]
     )[["datetime", "absolute"]].sort_values(by="datetime")
-    all_basal_rates = pd.merge_asof(
-        left=all_basal_rates,
-        right=basal_change_times,
-        left_on="datetime",
-        right_on="datetime",
-    ).rename(columns={"units_per_hour_scheduled": "scheduled"})
 
     # Make sure to drop duplicates while datetime is still part of the row!
     all_basal_rates.drop_duplicates(subset=["datetime"], inplace=True)
     all_basal_rates.set_index("datetime", drop=True, inplace=True)
 
-    # Sample in time domain instead of storing only change points
-    basals_per_min = all_basal_rates.asfreq("min", method="ffill")
-    basals_per_min = basals_per_min.loc[
-        (basals_per_min.index >= start_datetime)
-        & (basals_per_min.index <= end_datetime)
-    ]
-    basals_per_min["index"] = basals_per_min.index
-    # Add in auto-boluses to basal rates
-    auto_boluses = all_bg_data.loc[
-        (~pd.isna(all_bg_data["insulin"]))
-        & (all_bg_data["notes"] == "Automatic Bolus/Correction")
-        & (all_bg_data["datetime"] <= end_datetime)
-        & (all_bg_data["datetime"] >= start_datetime)
-    ][["datetime", "insulin"]]
-    auto_boluses = pd.merge_asof(
-        left=auto_boluses, right=basals_per_min, left_on="datetime", right_index=True
-    )
-    basals_per_min.loc[auto_boluses["index"], "absolute"] = (
-        basals_per_min.loc[auto_boluses["index"], "absolute"].values
-        + auto_boluses["insulin"].values
+    # Integrate the piecewise-constant rates exactly over each hour, rather than sampling them per minute
+    bin_edges = pd.date_range(
+        start=start_datetime,
+        periods=int((end_datetime - start_datetime) / BASAL_BIN_SIZE) + 1,
+        freq=BASAL_BIN_SIZE,
     )
-    basals_per_min["is_adjusted"] = (
-        basals_per_min["absolute"] != basals_per_min["scheduled"]
+    change_times_ns = to_epoch_ns(all_basal_rates.index)
+    bin_edges_ns = to_epoch_ns(bin_edges)
+    rates = all_basal_rates["absolute"].to_numpy(dtype=float)
+    avg_basal = get_bin_averages(change_times_ns, rates, bin_edges_ns)
+
+    # The schedule has its own change points: changes during a temp basal don't affect delivery, but still count here
+    scheduled_rates = (
+        pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        "datetime": [start_datetime],
+                        "units_per_hour_scheduled": schedule.lookup([start_datetime]),
+                    }
+                ),
+                basal_change_times,
+            ]
+        )
+        .sort_values(by="datetime", kind="stable")
+        .drop_duplicates(subset=["datetime"], keep="last")
     )
+    scheduled_change_times_ns = to_epoch_ns(scheduled_rates["datetime"])
+    scheduled = scheduled_rates["units_per_hour_scheduled"].to_numpy(dtype=float)
+    avg_scheduled = get_bin_averages(scheduled_change_times_ns, scheduled, bin_edges_ns)
 
-    def get_windowed_series(col: pd.Series, window_size: int) -> np.array:
-        """
-        Get a running sum of N values in a pandas Series, taken every N values
+    # Compare delivery with the schedule wherever either changes
+    all_change_times_ns = np.union1d(change_times_ns, scheduled_change_times_ns)
 
-        :param col: pandas Series of type float
-        :param window_size: number of values to group
-        :return: numpy array of sum of first window_size values, sum of next window_size values, etc.
-        """
-        np_col = col.to_numpy(dtype=float)
-        cumulative_col = np.cumsum(np_col)
-        cumulative_col[window_size:] = (
-            cumulative_col[window_size:] - cumulative_col[:-window_size]
+    def value_at(step_change_times_ns: np.ndarray, step_values: np.ndarray):
+        i_change = np.searchsorted(step_change_times_ns, all_change_times_ns, "right")
+        return step_values[np.maximum(i_change - 1, 0)]
+
+    is_adjusted = (
+        get_bin_averages(
+            all_change_times_ns,
+            (
+                value_at(change_times_ns, rates)
+                != value_at(scheduled_change_times_ns, scheduled)
+            ).astype(float),
+            bin_edges_ns,
         )
-        windowed_col = cumulative_col[window_size - 1 :: window_size] / window_size
-        return windowed_col
+        > 0
+    )
 
-    basals_per_hour = basals_per_min.iloc[59::60]
+    # Add in auto-boluses, spreading each dose over the bin it was given in
+    auto_boluses = all_bg_data.loc[
+        (~pd.isna(all_bg_data["insulin"]))
+        & (all_bg_data["notes"] == "Automatic Bolus/Correction")
+        & (all_bg_data["datetime"] < bin_edges[-1])
+        & (all_bg_data["datetime"] >= start_datetime)
+    ]
+    bolus_bins = (
+        np.searchsorted(bin_edges_ns, to_epoch_ns(auto_boluses["datetime"]), "right")
+        - 1
+    )
+    bin_hours = BASAL_BIN_SIZE / datetime.timedelta(hours=1)
+    avg_basal += (
+        np.bincount(
+            bolus_bins,
+            weights=auto_boluses["insulin"].to_numpy(dtype=float),
+            minlength=len(bin_edges) - 1,
+        )
+        / bin_hours
+    )
+    is_adjusted[bolus_bins] = True
 
-    basals_per_hour = basals_per_hour.assign(
-        avg_basal=get_windowed_series(basals_per_min["absolute"], 60),
-        is_adjusted=get_windowed_series(basals_per_min["is_adjusted"], 60) > 0,
-        time_label=pd.to_datetime(
-            start_datetime
-            + (basals_per_hour.index - start_datetime) % datetime.timedelta(days=1)
-        ),
-        date=basals_per_hour.index.date,
+    # Label each bin by its last minute, e.g. 00:59 for midnight - 1AM
+    bin_labels = bin_edges[1:] - datetime.timedelta(minutes=1)
+    basals_per_hour = pd.DataFrame(
+        {
+            "scheduled": avg_scheduled,
+            "is_adjusted": is_adjusted,
+            "avg_basal": avg_basal,
+            "time_label": pd.to_datetime(
+                start_datetime
+                + (bin_labels - start_datetime) % datetime.timedelta(days=1)
+            ),
+            "date": bin_labels.date,
+        },
+        index=pd.Index(bin_labels, name="datetime"),
     )
-    basals_per_hour.drop(columns=["absolute", "index"], inplace=True)
 
     return basals_per_hour
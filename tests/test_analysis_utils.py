@@ -0,0 +1,162 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nightscout_dash.analysis_utils import (
+    SITE_CHANGE_FINE_BIN_MINUTES,
+    daily_cumulative_histogram,
+    find_distinct_lows,
+    range_fractions,
+    site_change_accumulators,
+    summarize_accumulators,
+)
+
+# (low_threshold, recovered_threshold, n_recovered_pts_between_lows) combinations to check
+LOW_THRESHOLDS = [55, 70, 80]
+RECOVERED_THRESHOLDS = [70, 80, 100]
+N_RECOVERED_PTS = [0, 1, 5, 12, 50]
+
+
+def find_distinct_lows_loop(
+    cgm_data: pd.DataFrame,
+    low_threshold: float,
+    recovered_threshold: float,
+    n_recovered_pts_between_lows: int,
+) -> pd.Series:
+    """
+    The original implementation, looping over every low reading.
+    """
+    cgm_data = cgm_data.copy()
+    cgm_data["recovered_point_count"] = (cgm_data["bg"] > recovered_threshold).cumsum()
+    cgm_data["is_distinct_low"] = False
+    n_recovered_points_at_last_low = -n_recovered_pts_between_lows
+    for index, row in cgm_data.loc[cgm_data["bg"] <= low_threshold].iterrows():
+        is_distinct_low = (
+            row["recovered_point_count"]
+            >= n_recovered_points_at_last_low + n_recovered_pts_between_lows
+        )
+        if is_distinct_low:
+            n_recovered_points_at_last_low = row["recovered_point_count"]
+            cgm_data.loc[index, "is_distinct_low"] = True
+    return cgm_data["is_distinct_low"]
+
+
+@pytest.fixture(scope="module")
+def cgm_data() -> pd.DataFrame:
+    # Two weeks of 5-minute readings wandering in and out of the low range, with a few missing
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0, 10, 14 * 288)
+    deviation = np.zeros_like(noise)
+    for i in range(1, len(noise)):
+        deviation[i] = 0.97 * deviation[i - 1] + noise[i]
+    bg = np.clip(130 + deviation, 40, 400)
+    bg[rng.random(len(bg)) < 0.01] = np.nan
+    return pd.DataFrame({"bg": bg.astype(np.float32)})
+
+
+@pytest.mark.parametrize(
+    "params",
+    list(itertools.product(LOW_THRESHOLDS, RECOVERED_THRESHOLDS, N_RECOVERED_PTS)),
+)
+def test_find_distinct_lows_matches_loop(cgm_data, params):
+    expected = find_distinct_lows_loop(cgm_data, *params).to_numpy()
+    np.testing.assert_array_equal(find_distinct_lows(cgm_data["bg"], *params), expected)
+
+
+@pytest.mark.parametrize(
+    "bg", [[], [50], [50, 50, 50], [120, 120], [50, 120, 50, 120, 120, 50]]
+)
+def test_find_distinct_lows_edge_cases(bg):
+    cgm_data = pd.DataFrame({"bg": np.array(bg, dtype=float)})
+    for params in [(70, 80, 0), (70, 80, 1), (70, 80, 2)]:
+        expected = find_distinct_lows_loop(cgm_data, *params).to_numpy(dtype=bool)
+        np.testing.assert_array_equal(
+            find_distinct_lows(cgm_data["bg"], *params), expected
+        )
+
+
+@pytest.fixture(scope="module")
+def cgm_days(cgm_data) -> pd.DataFrame:
+    # Whole-number readings, as from a CGM, on the 14 days the fixture covers
+    return pd.DataFrame(
+        {
+            "bg": cgm_data["bg"].round(),
+            "date": pd.Timestamp("2022-11-01")
+            + pd.to_timedelta(np.arange(len(cgm_data)) // 288, unit="D"),
+        }
+    )
+
+
+def test_range_fractions_match_counting(cgm_days):
+    ranges = [(0, 54), (54, 70), (70, 180), (180, np.inf), (69.5, 70.5), (0, np.inf)]
+    histogram = daily_cumulative_histogram(cgm_days["bg"], cgm_days["date"])
+    overall, per_day = range_fractions(histogram, ranges)
+
+    readings = cgm_days.dropna()
+    for i, (lower, upper) in enumerate(ranges):
+        in_range = (readings["bg"] >= lower) & (readings["bg"] < upper)
+        assert overall[i] == pytest.approx(in_range.mean())
+        np.testing.assert_allclose(
+            per_day[i].to_numpy(), in_range.groupby(readings["date"]).mean().to_numpy()
+        )
+
+
+def test_daily_cumulative_histogram_clips_readings():
+    histogram = daily_cumulative_histogram(
+        pd.Series([-5, 0, 40, 5000, np.nan]), pd.Series(["a", "a", "b", "b", "b"])
+    )
+    assert histogram.shape == (2, 1002)
+    assert histogram.loc["a", 1] == 2
+    assert histogram.loc["b", 1000] == 1
+    assert list(histogram.iloc[:, -1]) == [2, 2]
+
+
+def test_site_change_accumulators_match_merge_asof():
+    rng = np.random.default_rng(1)
+    readings = pd.DataFrame(
+        {
+            "datetime": pd.date_range(
+                "2022-11-01", periods=7 * 288, freq="5min", tz="America/New_York"
+            ),
+            "eventType": "sgv",
+            "bg": rng.normal(140, 40, 7 * 288).round(),
+        }
+    )
+    readings.loc[rng.random(len(readings)) < 0.02, "bg"] = np.nan
+    site_changes = pd.DataFrame(
+        {
+            "datetime": pd.to_datetime(
+                ["2022-11-01 10:02", "2022-11-04 07:31", "2022-11-06 23:59"]
+            ).tz_localize("America/New_York"),
+            "eventType": "Site Change",
+            "bg": np.nan,
+        }
+    )
+    all_bg_data = pd.concat([readings, site_changes]).sort_values(
+        "datetime", kind="stable", ignore_index=True
+    )
+    all_bg_data["eventType"] = all_bg_data["eventType"].astype("category")
+
+    accumulators = site_change_accumulators(all_bg_data)
+    aligned = pd.merge_asof(
+        readings.dropna(),
+        site_changes[["datetime"]].assign(site_change=site_changes["datetime"]),
+        on="datetime",
+    ).dropna()
+    hours_since = (aligned["datetime"] - aligned["site_change"]) / np.timedelta64(
+        1, "h"
+    )
+    expected = aligned.groupby(hours_since // 4)["bg"].agg(["mean", "std", "count"])
+    by_hour_of_day = aligned.groupby(aligned["datetime"].dt.hour)["bg"].sum()
+    summary = summarize_accumulators(
+        accumulators,
+        accumulators["fine_bin"] * SITE_CHANGE_FINE_BIN_MINUTES // (4 * 60),
+    )
+    np.testing.assert_allclose(summary["mean_bg"], expected["mean"])
+    np.testing.assert_allclose(summary["std_bg"], expected["std"])
+    np.testing.assert_array_equal(summary["n"], expected["count"])
+    np.testing.assert_allclose(
+        accumulators.groupby("hour_of_day")["sum"].sum(), by_hour_of_day
+    )
@@ -0,0 +1,281 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nightscout_loader import (
+    BasalSchedule,
+    get_basal_per_hour,
+    get_bin_averages,
+    get_scheduled_basal,
+)
+
+TIMEZONE_NAME = "America/New_York"
+DATE = datetime.date(2022, 11, 15)
+MINUTE_NS = 60 * 10**9
+
+
+def local_time(hour: int, minute: int = 0, second: int = 0) -> pd.Timestamp:
+    return pd.Timestamp(
+        datetime.datetime.combine(DATE, datetime.time(hour, minute, second))
+    ).tz_localize(TIMEZONE_NAME)
+
+
+def make_profiles(*profiles) -> pd.DataFrame:
+    """
+    :param profiles: (profile_start_datetime, [(basal_start_time_seconds, units_per_hour_scheduled), ...]) tuples
+    :return: DataFrame in the format returned by fetch_profile_data
+    """
+    rows = [
+        {
+            "name": "Default",
+            "profile_start_datetime": start,
+            "basal_start_time_seconds": seconds,
+            "units_per_hour_scheduled": rate,
+            "profile_id": f"profile{i}",
+        }
+        for i, (start, rates) in enumerate(profiles)
+        for seconds, rate in rates
+    ]
+    return pd.DataFrame(rows)
+
+
+def make_treatments(temp_basals=(), auto_boluses=()) -> pd.DataFrame:
+    """
+    :param temp_basals: (datetime, duration in minutes, u/hr) tuples
+    :param auto_boluses: (datetime, units) tuples
+    :return: DataFrame with the treatment columns used by get_basal_per_hour, sorted by datetime
+    """
+    rows = [
+        {"datetime": when, "duration": duration, "absolute": rate, "reason": "test"}
+        for when, duration, rate in temp_basals
+    ] + [
+        {"datetime": when, "insulin": units, "notes": "Automatic Bolus/Correction"}
+        for when, units in auto_boluses
+    ]
+    columns = ["datetime", "duration", "absolute", "reason", "insulin", "notes"]
+    treatments = pd.DataFrame(rows, columns=columns)
+    treatments["datetime"] = pd.to_datetime(
+        treatments["datetime"], utc=True
+    ).dt.tz_convert(TIMEZONE_NAME)
+    for column in ["duration", "absolute", "insulin"]:
+        treatments[column] = treatments[column].astype(float)
+    return treatments.sort_values(by="datetime", ignore_index=True)
+
+
+def basal_per_hour(treatments: pd.DataFrame, profiles: pd.DataFrame) -> pd.DataFrame:
+    return get_basal_per_hour(treatments, profiles, DATE, DATE, TIMEZONE_NAME)
+
+
+@pytest.fixture
+def flat_profile() -> pd.DataFrame:
+    # 1 u/hr all day, in effect since well before DATE
+    return make_profiles((local_time(0) - datetime.timedelta(days=30), [(0, 1.0)]))
+
+
+def test_bin_averages_integrate_exactly_across_bin_edges():
+    # 1 u/hr from 0:00, 3 u/hr from 0:30, 2 u/hr from 1:30
+    change_times_ns = np.array([0, 30, 90]) * MINUTE_NS
+    values = np.array([1.0, 3.0, 2.0])
+    bin_edges_ns = np.array([0, 60, 120, 180]) * MINUTE_NS
+    np.testing.assert_allclose(
+        get_bin_averages(change_times_ns, values, bin_edges_ns), [2.0, 2.5, 2.0]
+    )
+
+
+def test_bin_averages_unknown_before_first_change_and_where_nan():
+    change_times_ns = np.array([30, 120, 150]) * MINUTE_NS
+    values = np.array([1.0, np.nan, 1.0])
+    bin_edges_ns = np.array([0, 60, 120, 180, 240]) * MINUTE_NS
+    averages = get_bin_averages(change_times_ns, values, bin_edges_ns)
+    np.testing.assert_array_equal(np.isnan(averages), [True, False, True, False])
+    np.testing.assert_allclose(averages[[1, 3]], [1.0, 1.0])
+
+
+def test_change_off_minute_boundary_is_integrated_exactly(flat_profile):
+    # 3 u/hr instead of 1 u/hr from 2:44:30 to 3:14:30: 15.5 minutes in one hour and 14.5 in the next, which a
+    # per-minute grid would round to 15 and 15
+    result = basal_per_hour(
+        make_treatments(temp_basals=[(local_time(2, 44, 30), 30, 3.0)]), flat_profile
+    )
+    np.testing.assert_allclose(
+        result["avg_basal"].iloc[2:4], [1 + 2 * 15.5 / 60, 1 + 2 * 14.5 / 60]
+    )
+
+
+def test_temp_basal_expiring_mid_hour(flat_profile):
+    result = basal_per_hour(
+        make_treatments(temp_basals=[(local_time(2), 30, 3.0)]), flat_profile
+    )
+    # Half an hour at 3 u/hr, then back to the scheduled 1 u/hr
+    assert result["avg_basal"].iloc[2] == pytest.approx(2.0)
+    assert result["is_adjusted"].iloc[2]
+    assert result["avg_basal"].iloc[3] == pytest.approx(1.0)
+    assert not result["is_adjusted"].iloc[3]
+    assert result["scheduled"].iloc[2] == pytest.approx(1.0)
+
+
+def test_zero_temp_basal_spanning_hours(flat_profile):
+    result = basal_per_hour(
+        make_treatments(temp_basals=[(local_time(4, 30), 90, 0.0)]), flat_profile
+    )
+    np.testing.assert_allclose(result["avg_basal"].iloc[4:7], [0.5, 0.0, 1.0])
+    np.testing.assert_array_equal(result["is_adjusted"].iloc[4:7], [True, True, False])
+
+
+def test_auto_boluses_in_the_same_minute_both_count(flat_profile):
+    result = basal_per_hour(
+        make_treatments(
+            auto_boluses=[(local_time(5, 10), 0.2), (local_time(5, 10, 30), 0.3)]
+        ),
+        flat_profile,
+    )
+    # Each bolus counts in full towards the hour it was given in
+    assert result["avg_basal"].iloc[5] == pytest.approx(1.5)
+    assert result["is_adjusted"].iloc[5]
+    assert result["avg_basal"].iloc[6] == pytest.approx(1.0)
+    assert not result["is_adjusted"].iloc[6]
+
+
+def test_bins_are_labelled_by_their_last_minute(flat_profile):
+    # The earliest change point is a temp basal set off the minute the day before; the bins still start at midnight
+    temp_basal_start = local_time(0) - datetime.timedelta(minutes=29, seconds=43)
+    result = basal_per_hour(
+        make_treatments(temp_basals=[(temp_basal_start, 20, 0.0)]), flat_profile
+    )
+    expected_labels = pd.DatetimeIndex(
+        [local_time(hour, 59) for hour in range(24)], name="datetime"
+    )
+    pd.testing.assert_index_equal(result.index, expected_labels)
+    assert (result["date"] == DATE).all()
+    assert list(result["time_label"]) == list(expected_labels)
+    np.testing.assert_allclose(result["avg_basal"], 1.0)
+    assert not result["is_adjusted"].any()
+
+
+def get_scheduled_basal_filter(
+    profiles: pd.DataFrame, timestamp: pd.Timestamp
+) -> float:
+    """
+    The original get_scheduled_basal, filtering the whole profiles frame for each timestamp.
+    """
+    timestamp = pd.to_datetime(timestamp)
+    applicable_profile_rows = profiles.loc[
+        (profiles["profile_start_datetime"] <= timestamp)
+        & (
+            profiles["basal_start_time_seconds"]
+            <= timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+        )
+    ]
+    return applicable_profile_rows.iloc[-1]["units_per_hour_scheduled"]
+
+
+@pytest.fixture
+def profile_switches() -> pd.DataFrame:
+    # Three profiles with different schedules, sorted by start time as fetch_profile_data returns them
+    return make_profiles(
+        (local_time(0) - datetime.timedelta(days=3), [(0, 0.5), (6 * 3600, 0.8)]),
+        (local_time(13, 20, 5), [(0, 0.6), (5400, 0.7), (18 * 3600, 0.9)]),
+        (local_time(0) + datetime.timedelta(days=2, hours=7), [(0, 1.1)]),
+    )
+
+
+def test_scheduled_basal_matches_original(profile_switches):
+    rng = np.random.default_rng(0)
+    first_start = profile_switches["profile_start_datetime"].iloc[0]
+    offsets = rng.integers(0, 6 * 24 * 3600, 200)
+    timestamps = [first_start + datetime.timedelta(seconds=int(s)) for s in offsets]
+    # Also the exact moments each profile and rate takes effect, and the second before
+    profile_starts = list(profile_switches["profile_start_datetime"].unique())
+    timestamps += profile_starts
+    timestamps += [t - datetime.timedelta(seconds=1) for t in profile_starts[1:]]
+    timestamps += [local_time(6), local_time(6) - datetime.timedelta(seconds=1)]
+    schedule = BasalSchedule(profile_switches)
+    expected = [get_scheduled_basal_filter(profile_switches, t) for t in timestamps]
+    np.testing.assert_array_equal(schedule.lookup(timestamps), expected)
+    assert [get_scheduled_basal(profile_switches, t) for t in timestamps] == expected
+
+
+def test_scheduled_basal_before_first_profile_is_nan(profile_switches):
+    first_start = profile_switches["profile_start_datetime"].iloc[0]
+    before = first_start - datetime.timedelta(seconds=1)
+    assert np.isnan(get_scheduled_basal(profile_switches, before))
+    np.testing.assert_array_equal(
+        np.isnan(BasalSchedule(profile_switches).lookup([before, first_start])),
+        [True, False],
+    )
+
+
+def test_profiles_are_ordered_by_start_time_not_id(profile_switches):
+    # Ids that sort in the opposite order to start times, and rows not sorted by start time
+    profile_switches["profile_id"] = profile_switches["profile_id"].map(
+        {"profile0": "c", "profile1": "b", "profile2": "a"}
+    )
+    shuffled = profile_switches.sample(frac=1, random_state=0)
+    schedule = BasalSchedule(shuffled)
+    timestamps = [local_time(12), local_time(14), local_time(19)]
+    np.testing.assert_array_equal(schedule.lookup(timestamps), [0.8, 0.7, 0.9])
+
+    change_times = schedule.get_change_times(DATE, DATE)
+    assert list(change_times["datetime"]) == [
+        local_time(0),
+        local_time(6),
+        local_time(13, 20, 5),
+        local_time(18),
+    ]
+    np.testing.assert_array_equal(
+        change_times["units_per_hour_scheduled"], [0.5, 0.8, 0.7, 0.9]
+    )
+
+
+def test_change_times_at_skipped_time_shift_forward():
+    # Clocks go from 2:00 to 3:00 on 2022-03-13 in America/New_York, so 2:30 never happens that day
+    date = datetime.date(2022, 3, 13)
+    start = pd.Timestamp("2022-03-01").tz_localize(TIMEZONE_NAME)
+    schedule = BasalSchedule(make_profiles((start, [(0, 0.5), (9000, 0.9)])))
+    change_times = schedule.get_change_times(date, date)
+    assert list(change_times["datetime"]) == [
+        pd.Timestamp("2022-03-13 00:00").tz_localize(TIMEZONE_NAME),
+        pd.Timestamp("2022-03-13 03:00").tz_localize(TIMEZONE_NAME),
+    ]
+    np.testing.assert_array_equal(change_times["units_per_hour_scheduled"], [0.5, 0.9])
+
+
+def test_change_times_at_ambiguous_time_use_first_occurrence():
+    # Clocks go from 2:00 back to 1:00 on 2022-11-06 in America/New_York, so 1:30 happens twice that day
+    date = datetime.date(2022, 11, 6)
+    start = pd.Timestamp("2022-11-01").tz_localize(TIMEZONE_NAME)
+    schedule = BasalSchedule(make_profiles((start, [(0, 0.5), (5400, 0.9)])))
+    change_times = schedule.get_change_times(date, date)
+    assert list(change_times["datetime"]) == [
+        pd.Timestamp("2022-11-06 00:00").tz_localize(TIMEZONE_NAME),
+        pd.Timestamp("2022-11-06 01:30-04:00").tz_convert(TIMEZONE_NAME),
+    ]
+    np.testing.assert_array_equal(change_times["units_per_hour_scheduled"], [0.5, 0.9])
+
+
+def test_scheduled_is_time_weighted_across_profile_switch():
+    profiles = make_profiles(
+        (local_time(0) - datetime.timedelta(days=30), [(0, 1.0)]),
+        (local_time(10, 15), [(0, 2.0)]),
+    )
+    result = basal_per_hour(make_treatments(), profiles)
+    # A quarter of the 10:00 hour at 1 u/hr and the rest at 2 u/hr
+    np.testing.assert_allclose(result["scheduled"].iloc[9:12], [1.0, 1.75, 2.0])
+    np.testing.assert_allclose(result["avg_basal"].iloc[9:12], [1.0, 1.75, 2.0])
+    assert not result["is_adjusted"].any()
+
+
+def test_scheduled_ignores_temp_basals_across_profile_switch():
+    profiles = make_profiles(
+        (local_time(0) - datetime.timedelta(days=30), [(0, 1.0)]),
+        (local_time(10, 15), [(0, 2.0)]),
+    )
+    # A temp basal covering the switch changes what was delivered, but not what was scheduled
+    result = basal_per_hour(
+        make_treatments(temp_basals=[(local_time(10), 30, 0.0)]), profiles
+    )
+    assert result["scheduled"].iloc[10] == pytest.approx(1.75)
+    assert result["avg_basal"].iloc[10] == pytest.approx(0.5 * 2.0)
+    assert result["is_adjusted"].iloc[10]
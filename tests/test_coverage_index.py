@@ -0,0 +1,88 @@
+import datetime
+
+import pandas as pd
+
+from nightscout_dash.coverage_index import CoverageIndex
+
+TIMEZONE = "America/New_York"
+
+
+def day(n: int) -> datetime.date:
+    return datetime.date(2022, 11, 1) + datetime.timedelta(days=n)
+
+
+def fetched_at(n: int, hour: int = 12) -> float:
+    # Unix time of hour o'clock local time on day(n)
+    return pd.Timestamp(day(n)).tz_localize(TIMEZONE).timestamp() + hour * 3600
+
+
+def make_index(*intervals) -> CoverageIndex:
+    coverage = CoverageIndex("https://example.com", TIMEZONE)
+    for start, end, fetched in intervals:
+        coverage.add(day(start), day(end), fetched)
+    return coverage
+
+
+def test_missing():
+    coverage = make_index((2, 4, fetched_at(20)), (6, 8, fetched_at(20)))
+    assert coverage.missing(day(0), day(10)) == [
+        (day(0), day(2)),
+        (day(4), day(6)),
+        (day(8), day(10)),
+    ]
+    assert coverage.missing(day(3), day(7)) == [(day(4), day(6))]
+    assert coverage.missing(day(2), day(4)) == []
+
+
+def test_incomplete():
+    # Day 5 was loaded while it was in progress, and day 6 less than the grace period after it ended
+    coverage = make_index((0, 6, fetched_at(5)), (6, 8, fetched_at(7, hour=0) + 1800))
+    assert coverage.incomplete(day(0), day(10)) == [(day(5), day(6)), (day(6), day(8))]
+    assert coverage.incomplete(day(0), day(5)) == []
+    assert coverage.incomplete(day(7), day(10)) == [(day(7), day(8))]
+
+
+def test_add_replaces_overlapped_dates():
+    # Loaded during day 8, so days 8 and 9 are incomplete
+    coverage = make_index((0, 10, fetched_at(8)))
+    coverage.add(day(3), day(5), fetched_at(9))
+    assert coverage.intervals == [
+        (day(0), day(5), fetched_at(9)),
+        (day(5), day(10), fetched_at(8)),
+    ]
+    coverage.add(day(5), day(7), fetched_at(30))
+    assert coverage.intervals == [
+        (day(0), day(7), fetched_at(30)),
+        (day(7), day(10), fetched_at(8)),
+    ]
+    assert coverage.incomplete(day(0), day(10)) == [(day(8), day(10))]
+
+
+def test_complete_intervals_merge_regardless_of_fetch_time():
+    coverage = make_index()
+    # Load one more day at a time, refreshing the day before, as browsing forward through old data would
+    for n in range(100):
+        coverage.add(day(n), day(n + 1), fetched_at(200 + n))
+    assert coverage.intervals == [(day(0), day(100), fetched_at(299))]
+    # Days loaded before they were over stay separate until they are refetched
+    coverage.add(day(100), day(101), fetched_at(100))
+    coverage.add(day(101), day(102), fetched_at(101))
+    assert len(coverage.intervals) == 3
+    coverage.add(day(100), day(101), fetched_at(101))
+    assert coverage.intervals == [
+        (day(0), day(101), fetched_at(299)),
+        (day(101), day(102), fetched_at(101)),
+    ]
+    # Within the grace period
+    coverage.add(day(101), day(102), fetched_at(102, hour=0) + 1800)
+    assert len(coverage.intervals) == 2
+    coverage.add(day(101), day(102), fetched_at(103))
+    assert coverage.intervals == [(day(0), day(102), fetched_at(299))]
+
+
+def test_json_round_trip():
+    coverage = make_index((0, 3, fetched_at(1)), (5, 6, fetched_at(20)))
+    restored = CoverageIndex.from_json(coverage.to_json())
+    assert restored.intervals == coverage.intervals
+    assert restored.matches("https://example.com", TIMEZONE)
+    assert not restored.matches("https://example.com", "UTC")
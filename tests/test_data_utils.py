@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from nightscout_dash.data_utils import (
+    binary_to_df,
+    bg_data_json_to_df,
+    df_to_binary,
+    df_to_store_data,
+    is_binary_payload,
+)
+from nightscout_loader import combine_entries_and_treatments
+
+TIMEZONE = "America/New_York"
+
+
+def make_mixed_df() -> pd.DataFrame:
+    datetimes = pd.to_datetime(
+        ["2022-11-06 05:30", "2022-11-06 06:30", None, "2022-11-07 12:00"], utc=True
+    ).tz_convert(TIMEZONE)
+    return pd.DataFrame(
+        {
+            "datetime": datetimes,
+            "date": pd.to_datetime(["2022-11-06", "2022-11-06", None, "2022-11-07"]),
+            "bg": np.array([100, np.nan, 110, 120], dtype=np.float32),
+            "duration": [30.0, np.nan, np.nan, 0.0],
+            "weekday_number": np.array([6, 6, 6, 0], dtype=np.int8),
+            "is_low": [False, True, False, False],
+            "eventType": pd.Categorical(["sgv", None, "Temp Basal", "sgv"]),
+            "empty_categorical": pd.Categorical([None] * 4, categories=["a", "b"]),
+            "notes": ["", None, "note", "ünïcode"],
+        },
+        index=[10, 11, 12, 13],
+    )
+
+
+def round_trip(df: pd.DataFrame) -> pd.DataFrame:
+    binary = df_to_binary(df)
+    assert is_binary_payload(binary)
+    decoded = binary_to_df(binary)
+    # tz-aware datetimes come back in UTC
+    for name, column in df.items():
+        if isinstance(column.dtype, pd.DatetimeTZDtype):
+            decoded[name] = decoded[name].dt.tz_convert(column.dt.tz)
+    return decoded
+
+
+def test_binary_round_trip_keeps_values_and_dtypes():
+    df = make_mixed_df()
+    decoded = round_trip(df)
+    pd.testing.assert_frame_equal(decoded, df, check_index_type=False)
+    assert list(decoded.index) == list(df.index)
+    assert decoded["eventType"].cat.categories.to_list() == ["Temp Basal", "sgv"]
+    assert decoded["eventType"].isna().to_list() == [False, True, False, False]
+
+
+def test_binary_round_trip_of_empty_frame():
+    df = make_mixed_df().iloc[:0]
+    pd.testing.assert_frame_equal(round_trip(df), df, check_index_type=False)
+
+
+def test_binary_round_trip_of_nightscout_data():
+    bg = pd.DataFrame(
+        {
+            "datetime": pd.date_range(
+                "2022-11-15", periods=3, freq="5min", tz=TIMEZONE
+            ),
+            "type": ["sgv", "sgv", "mbg"],
+            "bg": [100.0, np.nan, 95.0],
+        }
+    )
+    treatments = pd.DataFrame(
+        {
+            "datetime": pd.to_datetime(["2022-11-15 00:07"]).tz_localize(TIMEZONE),
+            "eventType": ["Temp Basal"],
+            "duration": [30.0],
+            "absolute": [0.5],
+            "enteredBy": ["loop"],
+        }
+    )
+    all_data = combine_entries_and_treatments(bg, treatments, TIMEZONE)
+    pd.testing.assert_frame_equal(round_trip(all_data), all_data)
+
+
+@pytest.mark.parametrize("store_mode", ["binary", "json"])
+def test_bg_data_json_to_df_round_trip(monkeypatch, store_mode):
+    monkeypatch.setenv("NIGHTSCOUT_STORE_MODE", store_mode)
+    df = make_mixed_df()[["datetime", "bg", "eventType"]].reset_index(drop=True)
+    decoded = bg_data_json_to_df(df_to_store_data(df), TIMEZONE)
+    pd.testing.assert_frame_equal(decoded, df, check_dtype=store_mode == "binary")
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from nightscout_dash.data_utils import (
+    DecodeCache,
+    bg_data_json_to_df,
+    df_to_store_data,
+)
+
+
+def make_bg_data() -> pd.DataFrame:
+    datetimes = pd.date_range(
+        "2022-11-01", periods=4, freq="5min", tz="America/New_York"
+    )
+    return pd.DataFrame(
+        {
+            "datetime": datetimes,
+            "bg": np.array([100, 110, np.nan, 120], dtype=np.float32),
+            "eventType": pd.Categorical(["sgv", "sgv", "Temp Basal", "sgv"]),
+            "date": datetimes.tz_localize(None).normalize(),
+            "weekday_number": np.array([1, 1, 1, 1], dtype=np.int8),
+            "notes": ["", "", "note", ""],
+        }
+    )
+
+
+@pytest.fixture
+def cache_and_expected():
+    cache = DecodeCache(max_bytes=1024 * 1024)
+    expected = make_bg_data()
+    cache.get_or_decode("bg", make_bg_data)
+    return cache, expected
+
+
+def test_cached_frame_matches_decoded(cache_and_expected):
+    cache, expected = cache_and_expected
+    cached = cache.get_or_decode("bg", make_bg_data)
+    pd.testing.assert_frame_equal(cached, expected)
+    assert cache.stats()["hits"] == 1
+
+
+def test_writing_into_cached_frame_raises(cache_and_expected):
+    cache, expected = cache_and_expected
+    cached = cache.get_or_decode("bg", make_bg_data)
+    with pytest.raises(ValueError):
+        cached.loc[0, "bg"] = 0
+    with pytest.raises(ValueError):
+        cached["weekday_number"].to_numpy()[0] = 0
+    with pytest.raises(ValueError):
+        cached["date"].to_numpy()[0] = np.datetime64("2000-01-01")
+    with pytest.raises(ValueError):
+        # Naive UTC view of the tz-aware values
+        cached["datetime"].values[0] = np.datetime64("2000-01-01")
+    pd.testing.assert_frame_equal(cache.get_or_decode("bg", make_bg_data), expected)
+
+
+def test_replacing_columns_only_affects_callers_copy(cache_and_expected):
+    cache, expected = cache_and_expected
+    cached = cache.get_or_decode("bg", make_bg_data)
+    cached["bg"] = cached["bg"] * 2
+    cached["new"] = 1
+    pd.testing.assert_frame_equal(cache.get_or_decode("bg", make_bg_data), expected)
+
+
+@pytest.mark.parametrize("store_mode", ["binary", "json", "server"])
+def test_writing_into_decoded_bg_data_raises(monkeypatch, store_mode):
+    monkeypatch.setenv("NIGHTSCOUT_STORE_MODE", store_mode)
+    bg_json = df_to_store_data(make_bg_data())
+    decoded = bg_data_json_to_df(bg_json, "America/New_York")
+    expected = decoded.copy(deep=True)
+    with pytest.raises(ValueError):
+        decoded.loc[0, "bg"] = 0
+    with pytest.raises(ValueError):
+        decoded["date"].to_numpy()[0] = np.datetime64("2000-01-01")
+    with pytest.raises(ValueError):
+        decoded["datetime"].values[0] = np.datetime64("2000-01-01")
+    pd.testing.assert_frame_equal(
+        bg_data_json_to_df(bg_json, "America/New_York"), expected
+    )
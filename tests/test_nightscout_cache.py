@@ -0,0 +1,90 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from nightscout_cache import NightscoutCache
+
+URL = "https://example.com"
+TIMEZONE = "America/New_York"
+DATE = datetime.date(2022, 11, 15)
+
+
+def make_partition(date: datetime.date) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "datetime": pd.date_range(date, periods=3, freq="5min", tz=TIMEZONE),
+            "bg": [100.0, 110.0, 120.0],
+        }
+    )
+
+
+def after_day_end(date: datetime.date, hours: float) -> float:
+    day_end = pd.Timestamp(date + datetime.timedelta(days=1)).tz_localize(TIMEZONE)
+    return day_end.timestamp() + hours * 3600
+
+
+@pytest.fixture
+def cache(tmp_path) -> NightscoutCache:
+    return NightscoutCache(str(tmp_path))
+
+
+def test_complete_partitions_round_trip(cache):
+    partitions = {
+        DATE: make_partition(DATE),
+        DATE + datetime.timedelta(days=1): make_partition(DATE).iloc[:0],
+    }
+    cache.put_partitions(URL, TIMEZONE, partitions, after_day_end(DATE, 2 + 24))
+    stored = cache.get_partitions(
+        URL, TIMEZONE, list(partitions) + [DATE - datetime.timedelta(days=1)]
+    )
+    assert list(stored) == list(partitions)
+    for date, df in partitions.items():
+        pd.testing.assert_frame_equal(stored[date], df)
+    assert cache.get_partitions(URL, "UTC", [DATE]) == {}
+    assert cache.get_partitions("https://other.example.com", TIMEZONE, [DATE]) == {}
+
+
+@pytest.mark.parametrize("hours_after_day_end", [-6, 0.5])
+def test_partitions_fetched_before_grace_period_are_not_served(
+    cache, hours_after_day_end
+):
+    cache.put_partitions(
+        URL,
+        TIMEZONE,
+        {DATE: make_partition(DATE)},
+        after_day_end(DATE, hours_after_day_end),
+    )
+    assert cache.get_partitions(URL, TIMEZONE, [DATE]) == {}
+    # Refetching later replaces the partition, which is then complete
+    cache.put_partitions(
+        URL, TIMEZONE, {DATE: make_partition(DATE)}, after_day_end(DATE, 2)
+    )
+    assert list(cache.get_partitions(URL, TIMEZONE, [DATE])) == [DATE]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = NightscoutCache(str(tmp_path))
+    dates = [DATE + datetime.timedelta(days=i) for i in range(3)]
+    for date in dates:
+        cache.put_partitions(
+            URL, TIMEZONE, {date: make_partition(date)}, after_day_end(date, 2)
+        )
+    # Touch the oldest partition, then shrink the cache to fit two partitions
+    cache.get_partitions(URL, TIMEZONE, [dates[0]])
+    with cache.connect() as conn:
+        sizes = [row[0] for row in conn.execute("SELECT size_bytes FROM partitions")]
+    cache.max_bytes = sum(sizes) - min(sizes)
+    cache.evict()
+    assert sorted(cache.get_partitions(URL, TIMEZONE, dates)) == [dates[0], dates[2]]
+
+
+def test_unreadable_partition_is_dropped(cache):
+    cache.put_partitions(
+        URL, TIMEZONE, {DATE: make_partition(DATE)}, after_day_end(DATE, 2)
+    )
+    with cache.connect() as conn:
+        conn.execute("UPDATE partitions SET data = ?", (b"not a pickle",))
+    assert cache.get_partitions(URL, TIMEZONE, [DATE]) == {}
+    with cache.connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM partitions").fetchone()[0] == 0
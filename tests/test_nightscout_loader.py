@@ -0,0 +1,132 @@
+import logging
+
+import pandas as pd
+import pytest
+
+from benchmarks.fake_nightscout_server import FakeNightscoutServer
+from nightscout_loader import (
+    NightscoutClient,
+    combine_entries_and_treatments,
+    entries_to_df,
+    get_entries_endpoint,
+    merge_sorted,
+    replace_tail,
+    treatments_to_df,
+)
+
+TIMEZONE = "America/New_York"
+START = pd.Timestamp("2022-11-15", tz=TIMEZONE)
+START_MS = int(START.timestamp() * 1000)
+MS_PER_5_MINUTES = 5 * 60 * 1000
+
+
+def make_entries(dates_ms, with_ids=True):
+    entries = []
+    for i, date in enumerate(dates_ms):
+        entry = {"date": date, "sgv": 100 + i, "type": "sgv"}
+        if with_ids:
+            entry["_id"] = f"entry{i}"
+        entries.append(entry)
+    return entries
+
+
+def fetch_all_entries(entries, page_size):
+    with FakeNightscoutServer(
+        {"entries": entries, "treatments": [], "profiles": []}
+    ) as server:
+        with NightscoutClient(server.url) as client:
+            return client.fetch_paged_records(
+                get_entries_endpoint(client.nightscout_url),
+                "date",
+                START_MS,
+                START_MS + 24 * 12 * MS_PER_5_MINUTES,
+                page_size=page_size,
+            )
+
+
+def sgvs(records):
+    return sorted(record["sgv"] for record in records)
+
+
+@pytest.mark.parametrize("page_size", [2, 3, 4, 7, 100])
+def test_page_boundary_splitting_shared_timestamp(page_size):
+    # Three pairs of records sharing a timestamp, so most page sizes split at least one of them
+    dates = [START_MS + (i // 2) * MS_PER_5_MINUTES for i in range(6)]
+    entries = make_entries(dates)
+    records = fetch_all_entries(entries, page_size)
+    assert sgvs(records) == sgvs(entries)
+    assert [record["date"] for record in records] == sorted(dates, reverse=True)
+
+
+@pytest.mark.parametrize("n_entries", [0, 1, 9, 10, 11])
+def test_short_last_page(n_entries):
+    entries = make_entries([START_MS + i * MS_PER_5_MINUTES for i in range(n_entries)])
+    assert sgvs(fetch_all_entries(entries, page_size=5)) == sgvs(entries)
+
+
+def test_records_without_ids_are_all_kept():
+    dates = [START_MS + (i // 2) * MS_PER_5_MINUTES for i in range(6)]
+    entries = make_entries(dates, with_ids=False)
+    # Including exact duplicates, which are indistinguishable from the same record fetched twice
+    entries.append(dict(entries[-1]))
+    records = fetch_all_entries(entries, page_size=3)
+    assert sgvs(records) == sgvs(entries[:-1])
+
+
+def test_warns_when_page_size_records_share_timestamp(caplog):
+    dates = [START_MS] * 2 + [START_MS + MS_PER_5_MINUTES] * 4
+    entries = make_entries(dates)
+    with caplog.at_level(logging.WARNING, logger="nightscout_loader"):
+        records = fetch_all_entries(entries, page_size=3)
+    assert "only the first 3 were fetched" in caplog.text
+    # The 3 records we could get at the crowded timestamp, and everything before it
+    assert len(records) == 5
+    assert sgvs(records[3:]) == [100, 101]
+
+
+def test_replace_tail_matches_full_refetch():
+    entries = make_entries([START_MS + i * MS_PER_5_MINUTES for i in range(20)])
+    since = START + pd.Timedelta(minutes=50)
+    updated_entries = [dict(entry) for entry in entries] + [
+        {"_id": "late", "date": START_MS + 20 * MS_PER_5_MINUTES, "sgv": 300}
+    ]
+    # A reading after since that changed on the server, and one before since that should be kept as loaded
+    updated_entries[15]["sgv"] = 250
+    updated_entries[2]["sgv"] = 50
+
+    def fetch_since(records, since):
+        with FakeNightscoutServer(
+            {"entries": records, "treatments": [], "profiles": []}
+        ) as server:
+            with NightscoutClient(server.url) as client:
+                return client.fetch_since(since, TIMEZONE, page_size=4)
+
+    all_data = fetch_since(entries, START)
+    merged = replace_tail(
+        all_data, fetch_since(updated_entries, since), since, TIMEZONE
+    )
+    expected = fetch_since(entries[:10] + updated_entries[10:], START)
+    pd.testing.assert_frame_equal(merged, expected)
+    assert merged["bg"].iloc[2] == 102
+    assert merged["bg"].iloc[15] == 250
+    assert merged["bg"].iloc[-1] == 300
+
+
+def test_merge_sorted_matches_sort():
+    def to_data(entries):
+        return combine_entries_and_treatments(
+            entries_to_df(entries, TIMEZONE), treatments_to_df([], TIMEZONE), TIMEZONE
+        )
+
+    entries = make_entries([START_MS + i * MS_PER_5_MINUTES for i in range(20)])
+    # Interleaved and overlapping, with two timestamps present in both (with different readings)
+    overlap = [dict(entry, sgv=entry["sgv"] + 100) for entry in entries[6:8]]
+    all_data = to_data(entries[:8] + entries[12:16])
+    new_data = to_data(overlap + entries[8:12] + entries[16:])
+    merged = merge_sorted(all_data, new_data, TIMEZONE)
+    # Stable sort puts all_data's reading first at each shared timestamp
+    expected = to_data(
+        sorted(entries[:16] + overlap + entries[16:], key=lambda e: e["date"])
+    )
+    pd.testing.assert_frame_equal(merged, expected)
+    assert merged["bg"].iloc[6:10].to_list() == [106, 206, 107, 207]